@@ -0,0 +1,189 @@
+import logging
+import threading
+import time
+
+
+class Series(object):
+    """Running aggregate of one field over the current window. Counters also
+    keep their previous sample across windows, as the base of the rate
+    """
+
+    __slots__ = ('min', 'max', 'sum', 'count', 'last', 'increase', 'elapsed', 'previous')
+
+    def __init__(self):
+        self.previous = None
+        self.reset()
+
+    def reset(self):
+        self.min = None
+        self.max = None
+        self.sum = 0.0
+        self.count = 0
+        self.last = None
+        self.increase = 0.0
+        self.elapsed = 0.0
+
+    def add(self, value, timestamp, counter):
+        self.last = value
+        self.count += 1
+        # only numbers get min / max / mean, other values just the last one
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        self.sum += value
+        if counter:
+            if self.previous is not None and timestamp > self.previous[1]:
+                # a counter going down was reset, it counted from 0 since
+                delta = value - self.previous[0]
+                self.increase += delta if delta >= 0 else value
+                self.elapsed += timestamp - self.previous[1]
+            self.previous = (value, timestamp)
+
+    def fields(self, name, counter):
+        if self.min is None:
+            return {name: self.last}
+        fields = {
+            name + '_min': self.min,
+            name + '_max': self.max,
+            name + '_mean': self.sum / self.count,
+            name + '_last': self.last,
+        }
+        if counter and self.elapsed > 0:
+            fields[name + '_rate'] = self.increase / self.elapsed
+        return fields
+
+
+class Aggregator(object):
+    """Tumbling window downsampling between the plugins and the publisher:
+    the points of a configured topic are folded, per measurement and field,
+    into windows of window seconds aligned on the epoch, and one point per
+    window is published when it ends, with the min, max, mean and last
+    value of each numeric field (timestamped at the start of the window),
+    plus the per second rate of the counters. Each series only keeps a few
+    numbers, whatever the sampling rate. The points may also be published
+    unchanged on a raw topic.
+
+    Meant for live sampled measurements: a point older than the window in
+    progress is folded into it
+    """
+
+    # seconds a window is kept open after its end, for the late samples
+    GRACE = 5
+
+    def __init__(self, publisher):
+        self.publisher = publisher
+        self.configs = {}
+        self.windows = {}
+        self.cond = threading.Condition()
+        self.running = False
+        self.thread = None
+
+    def configure(self, topic, window=None, counters=(), raw_topic=None):
+        """Aggregate the points of topic over window seconds, the fields
+        named in counters being cumulative counters. Without window, the
+        points of topic are no longer aggregated
+        """
+        with self.cond:
+            if window:
+                self.configs[topic] = {'window': window, 'counters': frozenset(counters), 'raw_topic': raw_topic}
+                return
+            keys = [k for k in self.windows if k[0] == topic]
+            points = self._close_all(k for k in keys if self.windows[k]['open'])
+            for key in keys:
+                del self.windows[key]
+            self.configs.pop(topic, None)
+        for t, point in points:
+            self.publisher.add(t, point)
+
+    def add(self, topic, point):
+        config = self.configs.get(topic)
+        if config is None:
+            # aggregation was just turned off
+            self.publisher.add(topic, point)
+            return
+        if config['raw_topic']:
+            self.publisher.add(config['raw_topic'], point)
+
+        window = config['window']
+        start = point['timestamp'] - point['timestamp'] % window
+        key = (topic, point['measurement'])
+        closed = None
+        with self.cond:
+            current = self.windows.get(key)
+            if current is None:
+                current = self.windows[key] = {'start': start, 'window': window, 'series': {}, 'open': False}
+            elif current['open'] and start > current['start']:
+                closed = self._close(key)
+            if not current['open']:
+                current['start'] = max(current['start'], start)
+                current['window'] = window
+                current['open'] = True
+                self.cond.notify()
+
+            counters = config['counters']
+            for name, value in point['fields'].items():
+                series = current['series'].get(name)
+                if series is None:
+                    series = current['series'][name] = Series()
+                series.add(value, point['timestamp'], name in counters)
+
+        if closed is not None:
+            self.publisher.add(*closed)
+
+    def _close(self, key):
+        """Aggregated point of the window of key, which is reset, None when
+        it has no field. The series are kept for the counters rates. Called
+        with the lock held
+        """
+        current = self.windows[key]
+        counters = self.configs.get(key[0], {}).get('counters', ())
+        fields = {}
+        for name, series in current['series'].items():
+            if series.count:
+                fields.update(series.fields(name, name in counters))
+            series.reset()
+        current['open'] = False
+        if not fields:
+            return None
+        return key[0], {'timestamp': current['start'], 'measurement': key[1], 'fields': fields}
+
+    def _close_all(self, keys):
+        return [closed for closed in map(self._close, keys) if closed is not None]
+
+    def start(self):
+        """Start the thread closing the windows once they ended
+        """
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='aggregator', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop the thread and publish the windows in progress
+        """
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        if self.thread is not None:
+            self.thread.join()
+        with self.cond:
+            points = self._close_all(k for k, w in self.windows.items() if w['open'])
+        for topic, point in points:
+            self.publisher.add(topic, point)
+
+    def run(self):
+        while True:
+            with self.cond:
+                if not self.running:
+                    return
+                now = time.time()
+                expired = [k for k, w in self.windows.items() if w['open'] and w['start'] + w['window'] + self.GRACE <= now]
+                points = self._close_all(expired)
+                if not expired:
+                    deadlines = [w['start'] + w['window'] + self.GRACE for w in self.windows.values() if w['open']]
+                    self.cond.wait(min(deadlines) - now if deadlines else None)
+                    continue
+
+            for topic, point in points:
+                logging.debug(f'aggregated window of {point["measurement"]} on {topic}')
+                self.publisher.add(topic, point)
@@ -0,0 +1,97 @@
+import datetime
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+class Backfill(object):
+    """Fetches the history of a plugin from day start to day end, split in
+    chunks the api accepts in one call (plugin.backfill_chunk). Chunks are
+    fetched by workers threads, their points are published as soon as a
+    chunk is done, then the chunk is recorded in a checkpoint file so that
+    an interrupted backfill resumes where it stopped
+    """
+
+    def __init__(self, plugin, start, end, workers=None, path=None):
+        if plugin.backfill_chunk is None:
+            raise ValueError(f'plugin {plugin.name} cannot fetch history')
+        if start > end:
+            raise ValueError(f'empty backfill range {start} to {end}')
+        self.plugin = plugin
+        self.start = start
+        self.end = end
+        self.workers = workers or plugin.backfill_workers
+        self.path = path or plugin.plugin_file('backfill.json')
+        self.done = self.checkpoint_load()
+
+    def chunks(self):
+        """(first day, last day) of each chunk of the range
+        """
+        step = self.plugin.backfill_chunk
+        day = self.start
+        while day <= self.end:
+            last = min(day + step - datetime.timedelta(days=1), self.end)
+            yield day, last
+            day = last + datetime.timedelta(days=1)
+
+    def checkpoint_load(self):
+        """Chunks already published by an earlier run of the same range
+        """
+        if not os.path.exists(self.path):
+            return set()
+        with open(self.path) as f:
+            checkpoint = json.load(f)
+        if checkpoint['from'] != self.start.isoformat() or checkpoint['to'] != self.end.isoformat():
+            logging.warning(f'ignoring checkpoint of backfill {checkpoint["from"]} to {checkpoint["to"]}')
+            return set()
+        return set(checkpoint['done'])
+
+    def checkpoint_save(self):
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump({'from': self.start.isoformat(), 'to': self.end.isoformat(), 'done': sorted(self.done)}, f)
+        os.replace(self.path + '.tmp', self.path)
+
+    def run(self):
+        """Fetch the chunks not done yet, returns True when the whole range
+        was published (the checkpoint is then removed)
+        """
+        chunks = [c for c in self.chunks() if self.key(c) not in self.done]
+        logging.info(f'backfilling {self.plugin.name} from {self.start} to {self.end}: '
+                     f'{len(chunks)} chunks to fetch, {len(self.done)} already done')
+
+        failed = 0
+        pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='backfill')
+        try:
+            futures = {pool.submit(self.fetch, *chunk): chunk for chunk in chunks}
+            for future in as_completed(futures):
+                chunk = futures[future]
+                if future.exception() is not None:
+                    failed += 1
+                    logging.error(f'backfill of {chunk[0]} to {chunk[1]} failed: {future.exception()}')
+                    continue
+                self.done.add(self.key(chunk))
+                self.checkpoint_save()
+                logging.info(f'backfilled {chunk[0]} to {chunk[1]} ({len(self.done)} chunks done)')
+        except KeyboardInterrupt:
+            logging.warning('backfill interrupted, the chunks in flight will be fetched again')
+            pool.shutdown(cancel_futures=True)
+            raise
+        finally:
+            pool.shutdown()
+
+        if failed:
+            logging.error(f'{failed} chunks failed, run the backfill again to retry them')
+            return False
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        return True
+
+    def fetch(self, first, last):
+        self.plugin.backfill(first, last)
+        # the chunk only counts as done once its points left the batches
+        self.plugin.publisher.flush(self.plugin.mqtt_topic)
+
+    @staticmethod
+    def key(chunk):
+        return f'{chunk[0].isoformat()}/{chunk[1].isoformat()}'
@@ -0,0 +1,92 @@
+#!python3
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from encoders import ENCODERS  # noqa: E402
+
+
+def synthetic_points(count):
+    """Points shaped like the raspi, solcast and fitbit ones
+    """
+    now = int(time.time())
+    points = []
+    for i in range(count):
+        kind = i % 3
+        if kind == 0:
+            points.append({
+                'timestamp': now + i,
+                'measurement': 'raspberrypi',
+                'fields': {
+                    'cpu_temp': round(random.uniform(40, 70), 3),
+                    'cpu_load_1m': round(random.uniform(0, 4), 2),
+                    'cpu_load_5m': round(random.uniform(0, 4), 2),
+                    'cpu_load_15m': round(random.uniform(0, 4), 2),
+                },
+            })
+        elif kind == 1:
+            points.append({
+                'timestamp': now + i,
+                'measurement': 'solcast',
+                'fields': {
+                    'global_horizontal_irradiance': random.randint(0, 1000),
+                    'direct_normal_irradiance': random.randint(0, 1000),
+                    'diffuse_horizontal_irradiance': random.randint(0, 500),
+                    'cloud_opacity': random.randint(0, 100),
+                },
+            })
+        else:
+            points.append({
+                'timestamp': now + i,
+                'measurement': 'activities',
+                'fields': {'steps': float(random.randint(0, 20000))},
+            })
+    return points
+
+
+def bench(encoder, points, batch_size, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        size = 0
+        for i in range(0, len(points), batch_size):
+            encoded = [encoder.encode(p) for p in points[i:i + batch_size]]
+            size += len(encoder.join(encoded))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return size, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='compare payload encoders against json')
+    parser.add_argument('-n', '--points', type=int, default=30000)
+    parser.add_argument('-b', '--batch', type=int, default=500)
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    random.seed(0)
+    points = synthetic_points(args.points)
+
+    results = {}
+    for name, cls in ENCODERS.items():
+        try:
+            encoder = cls()
+        except ImportError as ex:
+            print(f'{name:8s} skipped ({ex})')
+            continue
+        results[name] = bench(encoder, points, args.batch, args.repeat)
+
+    base_size, base_time = results['json']
+    print(f'{"encoding":8s} {"bytes/pt":>9s} {"us/pt":>7s} {"size":>6s} {"time":>6s}')
+    for name, (size, elapsed) in results.items():
+        print(f'{name:8s} {size / args.points:9.1f} {elapsed / args.points * 1e6:7.2f}'
+              f' {size / base_size:6.2f} {elapsed / base_time:6.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+#!python3
+
+import argparse
+import datetime
+import os
+import random
+import sys
+import time
+
+import dateutil.parser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_apis import fitbit_sleep_log  # noqa: E402
+from plugins.fitbit.fitbit import Fitbit, transform_sleep_datapoint  # noqa: E402
+from timestamps import parse_timestamp  # noqa: E402
+
+
+def sleep_payload(nights, entries):
+    """Synthetic sleep log api answer, entries levels.data items per night
+    """
+    first = datetime.date(2026, 1, 1)
+    return [fitbit_sleep_log(first + datetime.timedelta(days=night), entries) for night in range(nights)]
+
+
+def legacy_transform_sleep_datapoint(datapoint):
+    """Former transform: one record per field, every levels.data entry twice
+    """
+    d_t = datapoint['startTime']
+    ret_dps = []
+    for series in ['duration', 'efficiency', 'isMainSleep', 'timeInBed', 'minutesAfterWakeup',
+                   'minutesAsleep', 'minutesAwake', 'minutesToFallAsleep']:
+        ret_dps.append({'dateTime': d_t, 'meas': 'sleep', 'series': series, 'value': datapoint.get(series)})
+    levels = datapoint['levels']
+    for one_level, dict_level in levels['summary'].items():
+        for one_val in ['count', 'minutes', 'thirtyDayAvgMinutes']:
+            ret_dps.append({
+                'dateTime': d_t,
+                'meas': 'sleep_levels',
+                'series': one_level.lower() + '_' + one_val,
+                'value': dict_level.get(one_val)
+            })
+    for data_entry in levels['data']:
+        for one_val in ['level', 'seconds']:
+            ret_dps.append({
+                'dateTime': data_entry['dateTime'],
+                'meas': 'sleep_data',
+                'series': 'level_' + data_entry['level'],
+                'value': data_entry['seconds']
+            })
+    return ret_dps
+
+
+def legacy_create_api_datapoint_meas_series(measurement, series, value, in_dt):
+    if not value:
+        value = 0.0
+    try:
+        value = float(value)
+    except Exception:
+        pass
+    return {
+        "measurement": measurement,
+        "timestamp": int(datetime.datetime.timestamp(dateutil.parser.parse(in_dt))),
+        "fields": {series: value}
+    }
+
+
+def run_legacy(logs):
+    points = []
+    for log in logs:
+        for dp in legacy_transform_sleep_datapoint(log):
+            points.append(legacy_create_api_datapoint_meas_series(dp['meas'], dp['series'], dp['value'], dp['dateTime']))
+    return points
+
+
+def run_current(logs):
+    plugin = Fitbit.__new__(Fitbit)
+    points = []
+    for log in logs:
+        for dp in transform_sleep_datapoint(log):
+            points.append(plugin.create_api_datapoint(dp['meas'], dp['fields'], dp['dateTime']))
+    return points
+
+
+def main():
+    parser = argparse.ArgumentParser(description='fitbit sleep transform micro-benchmark')
+    parser.add_argument('-n', '--nights', type=int, default=30)
+    parser.add_argument('-e', '--entries', type=int, default=400)
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    random.seed(0)
+    logs = sleep_payload(args.nights, args.entries)
+
+    # the timestamp cache is cleared before each cold run, warm runs reuse
+    # the timestamps parsed by the run before (the same nights fetched again)
+    for name, func, cold in (('legacy', run_legacy, True), ('current', run_current, True), ('warm', run_current, False)):
+        best = None
+        parse_timestamp.cache_clear()
+        if not cold:
+            func(logs)
+        for _ in range(args.repeat):
+            if cold:
+                parse_timestamp.cache_clear()
+            start = time.perf_counter()
+            points = func(logs)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        fields = sum(len(p['fields']) for p in points)
+        print(f'{name:8s} {best * 1000:8.1f} ms {len(points):7d} points {fields:7d} fields')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,292 @@
+#!python3
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import resource
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT_DIR)
+
+from fake_apis import FakeApis  # noqa: E402
+from mqtt_broker import MqttBroker  # noqa: E402
+
+PLUGINS = ['freebox', 'enedis', 'solcast', 'fitbit']
+
+TOPICS = {
+    'freebox': '/net/freebox',
+    'enedis': '/power/enedis',
+    'solcast': '/power/solcast',
+    'fitbit': '/health/fitbit',
+}
+
+
+def plugin_configs(urls):
+    """config.json of each plugin, pointed at the fake apis. Every run
+    replays the same payloads, so deduplication is turned off
+    """
+    return {
+        'freebox': {
+            'discover_url': urls['freebox'] + '/api_version',
+            'url': urls['freebox'],
+            'certificate': '',
+            'token': 'bench',
+        },
+        'enedis': {'url': urls['enedis'] + '/api', 'pdl': 'bench', 'token': 'bench', 'deduplicate': False},
+        'solcast': {'url': urls['solcast'] + '/', 'api_key': 'bench', 'latitude': 0, 'longitude': 0, 'deduplicate': False},
+        'fitbit': {
+            'api_endpoint': urls['fitbit'],
+            'client_id': 'bench',
+            'client_secret': 'bench',
+            'access_token': 'bench',
+            'refresh_token': 'bench',
+            'deduplicate': False,
+        },
+    }
+
+
+def histogram_summary(samples):
+    """count, mean and approximate quantiles (bucket upper bounds) of the
+    histogram series of a metrics snapshot, merged
+    """
+    count = sum(s['value']['count'] for s in samples)
+    if not count:
+        return None
+    total = sum(s['value']['sum'] for s in samples)
+    buckets = {}
+    for sample in samples:
+        for bound, cumulative in sample['value']['buckets'].items():
+            buckets[bound] = buckets.get(bound, 0) + cumulative
+
+    def quantile(q):
+        for bound, cumulative in buckets.items():
+            if cumulative >= q * count:
+                return float(bound)
+
+    return {'count': count, 'mean': total / count, 'p50': quantile(0.5), 'p95': quantile(0.95), 'p99': quantile(0.99)}
+
+
+def proc_usage(pid):
+    """cpu seconds and current / peak rss bytes of a process, from /proc
+    """
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    rss = rss_max = 0
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                rss = int(line.split()[1]) * 1024
+            elif line.startswith('VmHWM:'):
+                rss_max = int(line.split()[1]) * 1024
+    return cpu, rss, rss_max
+
+
+def environment(broker, config_dir, work_dir, name):
+    env = dict(os.environ)
+    env.update({
+        'COLLECTOR_MQTT_HOST': broker.host,
+        'COLLECTOR_MQTT_PORT': str(broker.port),
+        'COLLECTOR_CONFIG_DIR': config_dir,
+        'COLLECTOR_OUTBOX_PATH': os.path.join(work_dir, f'outbox-{name}.sqlite'),
+        'COLLECTOR_METRICS_INTERVAL': '1',
+        'PYTHONPATH': ROOT_DIR,
+    })
+    env.pop('COLLECTOR_DEDUP_PATH', None)
+    return env
+
+
+def worker(name, iterations):
+    """Child process side of bench_plugin(): run the job of one plugin back
+    to back and print what was measured from the inside as JSON
+    """
+    os.chdir(ROOT_DIR)
+    from metrics import registry
+    from plugin import PluginCollection
+
+    plugins = PluginCollection('plugins', filter_by_names=[name])
+    plugin = plugins.plugins[0]
+    plugins.connect()
+
+    cpu = time.process_time()
+    start = time.perf_counter()
+    failures = 0
+    for _ in range(iterations):
+        try:
+            plugin.job()
+        except Exception as ex:
+            failures += 1
+            logging.error(f'{name} job failed: {ex}')
+    jobs = time.perf_counter() - start
+
+    plugins.publisher.flush()
+    plugins.close()
+    elapsed = time.perf_counter() - start
+
+    snapshot = json.loads(registry.to_json())['metrics']
+    points = sum(s['value'] for s in snapshot.get('collector_points_total', []))
+    print(json.dumps({
+        'iterations': iterations,
+        'failures': failures,
+        'points': points,
+        'jobs_time': jobs,
+        'elapsed': elapsed,
+        'cpu': time.process_time() - cpu,
+        'rss_max': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        'job_duration': histogram_summary(snapshot.get('collector_job_duration_seconds', [])),
+        'publish_latency': histogram_summary(snapshot.get('collector_publish_latency_seconds', [])),
+    }))
+
+
+def bench_plugin(name, args, broker, config_dir, work_dir):
+    broker.reset()
+    env = environment(broker, config_dir, work_dir, name)
+    out = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--worker', name, '--iterations', str(args.iterations)],
+        env=env, stdout=subprocess.PIPE, check=True).stdout
+    result = json.loads(out.decode('utf-8').strip().splitlines()[-1])
+
+    received = broker.stats(TOPICS[name])
+    result['received'] = received
+    result['points_per_s'] = received['points'] / result['elapsed'] if result['elapsed'] else 0
+    return result
+
+
+def bench_process(names, args, broker, config_dir, work_dir):
+    """Run collectors.py with the plugins for a while, sampling its cpu and
+    memory, then stop it like ^C would
+    """
+    broker.reset()
+    env = environment(broker, config_dir, work_dir, 'process')
+    command = [sys.executable, os.path.join(ROOT_DIR, 'collectors.py')]
+    for name in names:
+        command += ['-p', name]
+
+    log = open(os.path.join(work_dir, 'collectors.log'), 'w+')
+    process = subprocess.Popen(command, env=env, cwd=ROOT_DIR, stderr=log)
+    start = time.perf_counter()
+    rss_max = 0
+    cpu = 0.0
+    while time.perf_counter() - start < args.duration and process.poll() is None:
+        cpu, _, rss_max = proc_usage(process.pid)
+        time.sleep(0.5)
+    elapsed = time.perf_counter() - start
+    if process.poll() is not None:
+        log.seek(0)
+        logging.error(f'collectors.py exited early:\n{log.read()}')
+    process.send_signal(signal.SIGINT)
+    process.wait(timeout=30)
+    log.close()
+
+    received = broker.stats()
+    result = {
+        'duration': elapsed,
+        'cpu': cpu,
+        'cpu_percent': 100. * cpu / elapsed,
+        'rss_max': rss_max,
+        'received': received,
+        'points_per_s': received['points'] / elapsed,
+    }
+    metrics = broker.last.get('$collector/metrics')
+    if metrics is not None:
+        snapshot = json.loads(metrics)['metrics']
+        result['job_duration'] = histogram_summary(snapshot.get('collector_job_duration_seconds', []))
+        result['publish_latency'] = histogram_summary(snapshot.get('collector_publish_latency_seconds', []))
+    return result
+
+
+def compare(results, previous):
+    """Print the change of the main figures against an earlier result file
+    """
+    with open(previous) as f:
+        before = json.load(f)
+    runs = [(f'plugin {name}', result, before.get('plugins', {}).get(name)) for name, result in results['plugins'].items()]
+    runs.append(('process', results.get('process'), before.get('process')))
+    for label, now, then in runs:
+        if not now or not then:
+            continue
+        changes = []
+        for key in ('points_per_s', 'cpu', 'rss_max'):
+            if then.get(key):
+                changes.append(f'{key} {100. * (now[key] - then[key]) / then[key]:+.1f}%')
+        print(f'{label:16s} ' + ', '.join(changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='offline load test, against local broker and api stand-ins')
+    parser.add_argument('-p', '--plugin', action='append', choices=PLUGINS, help='plugins to bench (default: all)')
+    parser.add_argument('-s', '--size', type=int, default=500, help='entries per synthetic api answer')
+    parser.add_argument('-i', '--iterations', type=int, default=20, help='job runs per plugin')
+    parser.add_argument('-d', '--duration', type=float, default=20, help='seconds of collectors.py run (0 to skip)')
+    parser.add_argument('--payloads', help='directory of recorded api answers (<name>.json)')
+    parser.add_argument('-o', '--output', help='result file (default: bench/results/load-<date>.json)')
+    parser.add_argument('-c', '--compare', help='earlier result file to compare with')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', level=logging.ERROR)
+    if args.worker:
+        return worker(args.worker, args.iterations)
+
+    names = args.plugin or PLUGINS
+    apis = FakeApis(size=args.size, payload_dir=args.payloads)
+    apis.start()
+    broker = MqttBroker()
+    broker.start()
+
+    results = {
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'params': {'size': args.size, 'iterations': args.iterations, 'duration': args.duration, 'payloads': args.payloads},
+        'plugins': {},
+    }
+    try:
+        results['commit'] = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR, stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL, check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        config_dir = os.path.join(work_dir, 'config')
+        for name, config in plugin_configs(apis.urls).items():
+            os.makedirs(os.path.join(config_dir, name))
+            with open(os.path.join(config_dir, name, 'config.json'), 'w') as f:
+                json.dump(config, f)
+
+        for name in names:
+            result = results['plugins'][name] = bench_plugin(name, args, broker, config_dir, work_dir)
+            latency = result['publish_latency'] or {}
+            print(f'{name:8s} {result["points_per_s"]:10.0f} points/s {result["cpu"]:7.2f} s cpu'
+                  f' {result["rss_max"] / 2 ** 20:7.1f} MiB rss, publish latency mean {latency.get("mean", 0) * 1000:.1f} ms')
+
+        if args.duration > 0:
+            result = results['process'] = bench_process(names, args, broker, config_dir, work_dir)
+            print(f'{"process":8s} {result["points_per_s"]:10.0f} points/s {result["cpu_percent"]:7.1f} % cpu'
+                  f' {result["rss_max"] / 2 ** 20:7.1f} MiB rss over {result["duration"]:.0f} s')
+
+    broker.stop()
+    apis.stop()
+
+    output = args.output or os.path.join(BENCH_DIR, 'results', 'load-{}.json'.format(datetime.datetime.now().strftime('%Y%m%d-%H%M%S')))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'results saved to {output}')
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,225 @@
+import datetime
+import json
+import os
+import random
+import re
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def enedis_payload(size):
+    start = datetime.datetime.combine(datetime.date.today(), datetime.time()) - datetime.timedelta(days=3)
+    return {'meter_reading': {'interval_reading': [{
+        'date': (start + datetime.timedelta(minutes=30 * i)).strftime('%Y-%m-%d %H:%M:%S'),
+        'value': str(random.randint(100, 3000)),
+    } for i in range(size)]}}
+
+
+def solcast_payload(size):
+    end = datetime.datetime.now(datetime.timezone.utc).replace(minute=0, second=0, microsecond=0)
+    return {'estimated_actuals': [{
+        'period_end': (end - datetime.timedelta(minutes=30 * i)).strftime('%Y-%m-%dT%H:%M:%S.0000000Z'),
+        'period': 'PT30M',
+        'ghi': random.randint(0, 900),
+        'dni': random.randint(0, 900),
+        'dhi': random.randint(0, 300),
+        'cloud_opacity': random.randint(0, 100),
+    } for i in range(size)]}
+
+
+def freebox_connection_payload(size):
+    result = {
+        'type': 'ethernet',
+        'state': 'up',
+        'media': 'ftth',
+        'ipv4': '192.0.2.1',
+        'rate_down': random.randint(0, 10 ** 8),
+        'rate_up': random.randint(0, 10 ** 7),
+        'bytes_down': random.randint(0, 10 ** 12),
+        'bytes_up': random.randint(0, 10 ** 11),
+        'bandwidth_down': 1000000000,
+        'bandwidth_up': 600000000,
+    }
+    # the size pads the answer with extra counters
+    for i in range(max(0, size - len(result))):
+        result[f'counter_{i}'] = random.randint(0, 10 ** 9)
+    return {'success': True, 'result': result}
+
+
+def fitbit_days(base, end):
+    day = datetime.date.fromisoformat(base)
+    while day <= datetime.date.fromisoformat(end):
+        yield day
+        day += datetime.timedelta(days=1)
+
+
+def fitbit_sleep_log(day, size):
+    """Synthetic sleep log of the night starting on day, with size
+    levels.data items, also used by bench_fitbit_sleep.py
+    """
+    start = datetime.datetime.combine(day, datetime.time(23))
+    data = []
+    at = start
+    for _ in range(size):
+        seconds = random.choice([30, 60, 90, 120, 300])
+        data.append({'dateTime': at.strftime('%Y-%m-%dT%H:%M:%S.000'), 'level': random.choice(['wake', 'light', 'deep', 'rem']), 'seconds': seconds})
+        at += datetime.timedelta(seconds=seconds)
+    return {
+        'startTime': start.strftime('%Y-%m-%dT%H:%M:%S.000'),
+        'duration': int((at - start).total_seconds() * 1000),
+        'efficiency': random.randint(80, 99),
+        'isMainSleep': True,
+        'timeInBed': 480,
+        'minutesAfterWakeup': 1,
+        'minutesAsleep': 450,
+        'minutesAwake': 30,
+        'minutesToFallAsleep': 5,
+        'levels': {
+            'summary': {level: {'count': 3, 'minutes': 60, 'thirtyDayAvgMinutes': 70} for level in ['wake', 'light', 'deep', 'rem']},
+            'data': data,
+        },
+    }
+
+
+def fitbit_intraday_payload(resource, day, detail):
+    step = 1 if detail == '1sec' else 60
+    key = 'activities-' + resource.split('/', 1)[1]
+    low, high = (50, 180) if key == 'activities-heart' else (0, 150)
+    return {
+        key: [{'dateTime': day, 'value': '0'}],
+        key + '-intraday': {
+            'dataset': [{'time': f'{t // 3600:02d}:{t // 60 % 60:02d}:{t % 60:02d}', 'value': random.randint(low, high)}
+                        for t in range(0, 86400, step)],
+            'datasetInterval': 1,
+            'datasetType': 'second' if step == 1 else 'minute',
+        },
+    }
+
+
+def fitbit_payload(resource, base, end, size):
+    days = list(fitbit_days(base, end))
+    if resource == 'sleep':
+        return {'sleep': [fitbit_sleep_log(day, size) for day in days]}
+    key = 'activities-' + resource.split('/', 1)[1].replace('/', '-')
+    if resource == 'activities/heart':
+        zones = [{'name': name, 'caloriesOut': 100.0, 'max': 100 + 30 * i, 'min': 70 + 30 * i, 'minutes': 60}
+                 for i, name in enumerate(['Out of Range', 'Fat Burn', 'Cardio', 'Peak'])]
+        return {key: [{'dateTime': day.isoformat(), 'value': {'restingHeartRate': random.randint(50, 70), 'heartRateZones': zones}}
+                      for day in days]}
+    return {key: [{'dateTime': day.isoformat(), 'value': str(random.randint(0, 20000))} for day in days]}
+
+
+class FakeApiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    FITBIT_PATH = re.compile(r'^/[\d.]+/user/-/(.+)/date/(\d{4}-\d{2}-\d{2})/(\d{4}-\d{2}-\d{2})\.json$')
+    FITBIT_INTRADAY_PATH = re.compile(r'^/[\d.]+/user/-/(.+)/date/(\d{4}-\d{2}-\d{2})/1d/(1sec|1min)\.json$')
+
+    def do_GET(self):
+        self.route()
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        if length:
+            self.rfile.read(length)
+        self.route()
+
+    def route(self):
+        api = self.server.api
+        path = urllib.parse.urlsplit(self.path).path
+        name = self.server.name
+
+        if name == 'enedis':
+            return self.reply(api.payload('enedis', lambda: enedis_payload(api.size)))
+        if name == 'solcast':
+            return self.reply(api.payload('solcast', lambda: solcast_payload(api.size)))
+        if name == 'freebox':
+            if path == '/api_version':
+                return self.reply({'api_base_url': '/api/', 'api_version': '8.0'})
+            if path == '/api/v8/login/':
+                return self.reply({'success': True, 'result': {'challenge': 'bench', 'logged_in': False}})
+            if path == '/api/v8/login/session/':
+                return self.reply({'success': True, 'result': {'session_token': 'bench'}})
+            if path == '/api/v8/connection/':
+                return self.reply(api.payload('freebox_connection', lambda: freebox_connection_payload(api.size)))
+        if name == 'fitbit':
+            match = self.FITBIT_INTRADAY_PATH.match(path)
+            if match:
+                resource, day, detail = match.groups()
+                recorded = 'fitbit_' + resource.replace('/', '_') + '_' + detail
+                return self.reply(api.payload(recorded, lambda: fitbit_intraday_payload(resource, day, detail), key=path))
+            match = self.FITBIT_PATH.match(path)
+            if match:
+                resource, base, end = match.groups()
+                recorded = 'fitbit_' + resource.replace('/', '_')
+                return self.reply(api.payload(recorded, lambda: fitbit_payload(resource, base, end, api.size), key=path), headers={
+                    'Fitbit-Rate-Limit-Limit': '150',
+                    'Fitbit-Rate-Limit-Remaining': '150',
+                    'Fitbit-Rate-Limit-Reset': '3600',
+                })
+        self.reply({'error': 'not found'}, status=404)
+
+    def reply(self, body, status=200, headers=None):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.api.requests += 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeApis(object):
+    """Local stand-ins of the Freebox, Enedis, Solcast and Fitbit apis, one
+    http server each. Answers are read from <name>.json in payload_dir when
+    present (recorded payloads), otherwise generated with size entries
+    """
+
+    NAMES = ('freebox', 'enedis', 'solcast', 'fitbit')
+
+    def __init__(self, size=500, payload_dir=None, host='127.0.0.1'):
+        self.size = size
+        self.payload_dir = payload_dir
+        self.requests = 0
+        self.cache = {}
+        self.servers = {}
+        for name in self.NAMES:
+            server = ThreadingHTTPServer((host, 0), FakeApiHandler)
+            server.daemon_threads = True
+            server.name = name
+            server.api = self
+            self.servers[name] = server
+        self.urls = {name: 'http://{}:{}'.format(*server.server_address) for name, server in self.servers.items()}
+
+    def start(self):
+        for name, server in self.servers.items():
+            threading.Thread(target=server.serve_forever, name=f'fake-{name}', daemon=True).start()
+
+    def stop(self):
+        for server in self.servers.values():
+            server.shutdown()
+            server.server_close()
+
+    def payload(self, name, generate, key=None):
+        """Encoded answer, generated (or read) once and then served again
+        """
+        key = key or name
+        body = self.cache.get(key)
+        if body is not None:
+            return body
+
+        path = os.path.join(self.payload_dir, name + '.json') if self.payload_dir else None
+        if path and os.path.exists(path):
+            with open(path, 'rb') as f:
+                body = f.read()
+        else:
+            body = json.dumps(generate()).encode('utf-8')
+        self.cache[key] = body
+        return body
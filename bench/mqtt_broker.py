@@ -0,0 +1,131 @@
+import json
+import socket
+import socketserver
+import threading
+import time
+
+
+CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP = 1, 2, 3, 4, 5, 6, 7
+SUBSCRIBE, SUBACK, PINGREQ, PINGRESP, DISCONNECT = 8, 9, 12, 13, 14
+
+
+class BrokerHandler(socketserver.BaseRequestHandler):
+    """One client connection: answers the MQTT 3.1.1 control packets a
+    publisher sends and hands every PUBLISH to the broker
+    """
+
+    def handle(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.rfile = self.request.makefile('rb')
+        while True:
+            header = self.rfile.read(1)
+            if not header:
+                return
+            length = 0
+            for shift in range(0, 28, 7):
+                byte = self.rfile.read(1)
+                if not byte:
+                    return
+                length |= (byte[0] & 0x7f) << shift
+                if not byte[0] & 0x80:
+                    break
+            body = self.rfile.read(length)
+
+            kind = header[0] >> 4
+            if kind == CONNECT:
+                self.request.sendall(bytes([CONNACK << 4, 2, 0, 0]))
+            elif kind == PUBLISH:
+                qos = (header[0] >> 1) & 3
+                size = int.from_bytes(body[:2], 'big')
+                topic = body[2:2 + size].decode('utf-8')
+                payload = body[2 + size + (2 if qos else 0):]
+                self.server.broker.received(topic, payload)
+                if qos == 1:
+                    self.request.sendall(bytes([PUBACK << 4, 2]) + body[2 + size:4 + size])
+                elif qos == 2:
+                    self.request.sendall(bytes([PUBREC << 4, 2]) + body[2 + size:4 + size])
+            elif kind == PUBREL:
+                self.request.sendall(bytes([PUBCOMP << 4, 2]) + body[:2])
+            elif kind == SUBSCRIBE:
+                granted = bytearray()
+                offset = 2
+                while offset < len(body):
+                    offset += 2 + int.from_bytes(body[offset:offset + 2], 'big')
+                    granted.append(min(body[offset], 1))
+                    offset += 1
+                self.request.sendall(bytes([SUBACK << 4, 2 + len(granted)]) + body[:2] + granted)
+            elif kind == PINGREQ:
+                self.request.sendall(bytes([PINGRESP << 4, 0]))
+            elif kind == DISCONNECT:
+                return
+
+
+class BrokerServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class MqttBroker(object):
+    """In-process MQTT broker stand-in: it accepts publishers, acknowledges
+    their messages and only keeps per topic counters (messages, bytes,
+    points of JSON list payloads, first and last arrival) and the last
+    payload of each topic. Nothing is forwarded to subscribers
+    """
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.server = BrokerServer((host, port), BrokerHandler)
+        self.server.broker = self
+        self.host, self.port = self.server.server_address
+        self.lock = threading.Lock()
+        self.topics = {}
+        self.last = {}
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name='broker', daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset(self):
+        with self.lock:
+            self.topics = {}
+            self.last = {}
+
+    def received(self, topic, payload):
+        now = time.time()
+        points = 0
+        if payload[:1] == b'[':
+            try:
+                points = len(json.loads(payload))
+            except ValueError:
+                pass
+        elif payload[:1] == b'{':
+            points = 1
+
+        with self.lock:
+            stats = self.topics.get(topic)
+            if stats is None:
+                stats = self.topics[topic] = {'messages': 0, 'bytes': 0, 'points': 0, 'first': now, 'last': now}
+            stats['messages'] += 1
+            stats['bytes'] += len(payload)
+            stats['points'] += points
+            stats['last'] = now
+            self.last[topic] = payload
+
+    def stats(self, topic=None):
+        """Counters of topic (and its encoding suffixed variants), or of all
+        topics but the metrics one
+        """
+        total = {'messages': 0, 'bytes': 0, 'points': 0, 'first': None, 'last': None}
+        with self.lock:
+            for name, stats in self.topics.items():
+                if topic is None and name.startswith('$'):
+                    continue
+                if topic is not None and not (name == topic or name.startswith(topic + '/')):
+                    continue
+                for key in ('messages', 'bytes', 'points'):
+                    total[key] += stats[key]
+                total['first'] = stats['first'] if total['first'] is None else min(total['first'], stats['first'])
+                total['last'] = stats['last'] if total['last'] is None else max(total['last'], stats['last'])
+        return total
@@ -1,14 +1,38 @@
 #!python3
 
+import argparse
 import logging
+import os
 
 from plugin import PluginCollection
+from supervisor import Supervisor
 
 
 def main():
-    plugins = PluginCollection('plugins')
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--plugin', action='append', help='only run these plugins, active or not')
+    parser.add_argument('-r', '--runtime', choices=['threads', 'asyncio'], default=os.getenv('COLLECTOR_RUNTIME', 'threads'))
+    parser.add_argument('-w', '--workers', type=int, default=int(os.getenv('COLLECTOR_WORKERS', 0)),
+                        help='run the plugins in that many worker processes (0: in this process)')
+    parser.add_argument('-g', '--group', action='append', default=[], help='comma separated plugins to run in the same worker')
+    args = parser.parse_args()
+
+    if args.workers > 0:
+        groups = [group.split(',') for group in args.group]
+        Supervisor('plugins', args.workers, groups=groups, filter_by_names=args.plugin, runtime=args.runtime).run()
+        return
+
+    plugins = PluginCollection('plugins', filter_by_names=args.plugin)
     plugins.list()
-    plugins.schedule()
+    if args.runtime == 'asyncio':
+        plugins.run_async()
+        return
+
+    plugins.connect()
+    try:
+        plugins.schedule()
+    finally:
+        plugins.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,106 @@
+import json
+import logging
+import os
+import threading
+
+
+class ConfigStore(object):
+    """Parsed config.json files, cached until the file changes on disk.
+    Saves go through a temporary file renamed over the original, so a
+    reader never sees a partially written file. Watched files are polled
+    every poll_interval seconds and their callbacks get the new config
+    when the file was changed by someone else (a removed file keeps its
+    last config)
+    """
+
+    def __init__(self, poll_interval=None):
+        self.poll_interval = poll_interval or float(os.getenv('COLLECTOR_CONFIG_POLL', 2))
+        self.lock = threading.RLock()
+        self.cache = {}
+        self.watches = {}
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def signature(self, path):
+        # the inode changes on each rename, even within the mtime resolution
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size, st.st_ino
+
+    def load(self, path):
+        """Parsed content of path, {} when it does not exist
+        """
+        with self.lock:
+            signature = self.signature(path)
+            cached = self.cache.get(path)
+            if cached is not None and cached[0] == signature:
+                return cached[1]
+
+            config = {}
+            if signature is not None:
+                with open(path) as f:
+                    config = json.load(f)
+            self.cache[path] = (signature, config)
+            return config
+
+    def save(self, path, config):
+        with self.lock:
+            with open(path + '.tmp', 'w') as f:
+                json.dump(config, f, indent=4)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path + '.tmp', path)
+            # our own write must not be reported as a change
+            self.cache[path] = (self.signature(path), config)
+
+    def watch(self, path, callback):
+        """Call callback(config) whenever path is changed on disk
+        """
+        with self.lock:
+            self.load(path)
+            self.watches.setdefault(path, []).append(callback)
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name='config-watch', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.poll_interval):
+            self.poll()
+
+    def poll(self):
+        for path, callbacks in list(self.watches.items()):
+            with self.lock:
+                signature = self.signature(path)
+                if self.cache[path][0] == signature:
+                    continue
+                if signature is None:
+                    logging.warning(f'{path} was removed, keeping its last settings')
+                    self.cache[path] = (signature, self.cache[path][1])
+                    continue
+                try:
+                    config = self.load(path)
+                except (OSError, ValueError) as ex:
+                    # most likely still being written, wait for the next change
+                    logging.warning(f'ignoring invalid {path}: {ex}')
+                    self.cache[path] = (signature, self.cache[path][1])
+                    continue
+
+            logging.info(f'{path} changed, reloading')
+            for callback in callbacks:
+                try:
+                    callback(config)
+                except Exception as ex:
+                    logging.exception(f'reloading {path} failed: {ex}')
+
+
+# store shared by all the plugins
+store = ConfigStore()
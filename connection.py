@@ -0,0 +1,307 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+import metrics
+
+
+class MqttConnection(object):
+    """Long-lived MQTT connection shared by all plugins. The network loop
+    runs in its own thread and paho takes care of reconnecting, so plugins
+    only have to call publish().
+
+    With an outbox, published messages are spooled on disk and sent at
+    QoS 1, they are removed from the spool once the broker acknowledged
+    them. Whatever is left in the spool is replayed, at most replay_rate
+    messages per second, each time the connection is (re)established.
+
+    With the asyncio runtime, start_async() replaces the network thread:
+    the socket is watched by the event loop and the connection is kept
+    alive (and reestablished) by a task of that loop
+    """
+
+    def __init__(self, client_id='collector', outbox=None, replay_rate=None):
+        self.client_id = client_id
+        self.host = os.getenv('COLLECTOR_MQTT_HOST', 'localhost')
+        self.port = int(os.getenv('COLLECTOR_MQTT_PORT', 1883))
+
+        self.connected = threading.Event()
+        self.lock = threading.Lock()
+
+        self.outbox = outbox
+        self.replay_rate = replay_rate or float(os.getenv('COLLECTOR_OUTBOX_REPLAY_RATE', 100))
+        self.replay_window = 100
+        self.replay_needed = threading.Event()
+        self.replay_thread = None
+        self.running = False
+        self.loop = None
+        self.misc_task = None
+        self.inflight_lock = threading.Lock()
+        self.inflight = {}
+        self.sent_at = {}
+        # acknowledgements received while a spooled send did not record its
+        # mid yet, only kept while such sends are in progress
+        self.sending = 0
+        self.early_acks = {}
+
+        self.client = mqtt.Client(client_id)
+        self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
+        self.client.on_message = self.on_message
+        self.client.on_publish = self.on_publish
+        self.client.on_subscribe = self.on_subscribe
+        self.client.on_log = self.on_log
+
+        self.client.username_pw_set(
+                os.getenv('COLLECTOR_MQTT_USER', 'sysadmin'),
+                os.getenv('COLLECTOR_MQTT_PASS', 'sysadmin'))
+        self.client.reconnect_delay_set(min_delay=1, max_delay=60)
+
+    def start(self, timeout=10):
+        """Start the network loop thread and wait (at most timeout seconds)
+        for the first connection to be established
+        """
+        self._start_replay()
+
+        logging.info(f'connecting to mqtt broker {self.host}:{self.port}')
+        self.client.connect_async(self.host, port=self.port)
+        self.client.loop_start()
+        if not self.connected.wait(timeout):
+            logging.warning(f'not yet connected to mqtt broker {self.host}:{self.port}, will keep retrying')
+
+    def stop(self, timeout=5):
+        """Wait (at most timeout seconds) for the spooled messages in flight
+        to be acknowledged, then disconnect and stop the network loop thread
+        """
+        self._stop_replay()
+
+        deadline = time.monotonic() + timeout
+        while self.inflight and self.connected.is_set() and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+        self.client.disconnect()
+        self.client.loop_stop()
+        if self.outbox is not None:
+            self.outbox.close()
+
+    def start_async(self, loop):
+        """Drive the network I/O from the asyncio event loop instead of a
+        thread, paho telling which socket to watch through its socket callbacks
+        """
+        self.loop = loop
+        self.client.on_socket_open = self.on_socket_open
+        self.client.on_socket_close = self.on_socket_close
+        self.client.on_socket_register_write = self.on_socket_register_write
+        self.client.on_socket_unregister_write = self.on_socket_unregister_write
+        self._start_replay()
+
+        logging.info(f'connecting to mqtt broker {self.host}:{self.port}')
+        self.misc_task = loop.create_task(self.misc_loop())
+
+    async def stop_async(self, timeout=5):
+        """Coroutine counterpart of stop(), the acknowledgements being read
+        by the event loop while waiting for them
+        """
+        await self.loop.run_in_executor(None, self._stop_replay)
+
+        deadline = time.monotonic() + timeout
+        while self.inflight and self.connected.is_set() and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+        self.client.disconnect()
+        self.misc_task.cancel()
+        if self.outbox is not None:
+            self.outbox.close()
+
+    async def misc_loop(self):
+        """Keepalive and retries housekeeping, reconnecting with backoff
+        whenever the connection is lost
+        """
+        delay = 1
+        while self.running:
+            if self.client.socket() is None:
+                try:
+                    # connect() blocks on name resolution and the tcp handshake
+                    await self.loop.run_in_executor(None, self.client.connect, self.host, self.port)
+                except OSError as ex:
+                    logging.warning(f'cannot connect to mqtt broker {self.host}:{self.port} ({ex}), retrying in {delay}s')
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 60)
+                    continue
+                delay = 1
+            self.client.loop_misc()
+            await asyncio.sleep(1)
+
+    def _start_replay(self):
+        self.running = True
+        if self.outbox is not None:
+            self.replay_thread = threading.Thread(target=self.replay, name='outbox-replay', daemon=True)
+            self.replay_thread.start()
+
+    def _stop_replay(self):
+        self.running = False
+        self.replay_needed.set()
+        if self.replay_thread is not None:
+            self.replay_thread.join()
+
+    def _watch(self, method, *args):
+        # paho calls the socket callbacks from whichever thread publishes or
+        # connects, the event loop has to be updated from its own thread
+        def update():
+            try:
+                method(*args)
+            except (OSError, ValueError) as ex:
+                logging.debug(f'socket watch update failed: {ex}')
+
+        try:
+            on_loop = asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            on_loop = False
+        if on_loop:
+            update()
+        else:
+            self.loop.call_soon_threadsafe(update)
+
+    def publish(self, topic, payload, qos=0, retain=False, spool=True):
+        """Thread safe publish. Unless spool is False, messages go through the
+        outbox when there is one: they are only sent right away if connected,
+        otherwise they wait in the spool for the next replay
+        """
+        if self.outbox is None or not spool:
+            return self._publish(topic, payload, qos, retain)
+
+        row_id = self.outbox.put(topic, payload)
+        if row_id is not None and self.connected.is_set():
+            return self._send(row_id, topic, payload)
+        return None
+
+    def _publish(self, topic, payload, qos, retain=False):
+        with self.lock:
+            info = self.client.publish(topic, payload, qos=qos, retain=retain)
+        # with QoS > 0 paho keeps the message queued until the connection is back
+        if info.rc != mqtt.MQTT_ERR_SUCCESS and not (info.rc == mqtt.MQTT_ERR_NO_CONN and qos > 0):
+            metrics.registry.inc('collector_publish_failures_total', topic=topic)
+            logging.warning(f'publish to {topic} failed: {mqtt.error_string(info.rc)}')
+        else:
+            metrics.registry.inc('collector_published_messages_total', topic=topic)
+            metrics.registry.inc('collector_published_bytes_total', len(payload), topic=topic)
+        return info
+
+    def _send(self, row_id, topic, payload):
+        with self.inflight_lock:
+            self.sending += 1
+        sent = time.monotonic()
+        try:
+            info = self._publish(topic, payload, 1)
+        except Exception:
+            with self.inflight_lock:
+                self._sent()
+            raise
+
+        with self.inflight_lock:
+            # the acknowledgement may already have been received, see on_publish
+            acked = self.early_acks.pop(info.mid, None)
+            self._sent()
+            if info.rc not in (mqtt.MQTT_ERR_SUCCESS, mqtt.MQTT_ERR_NO_CONN):
+                # not queued by paho, the message stays in the spool
+                return info
+            if acked is None:
+                self.inflight[info.mid] = row_id
+                self.sent_at[info.mid] = sent
+                return info
+        metrics.registry.observe('collector_publish_latency_seconds', acked - sent)
+        self.outbox.ack(row_id)
+        return info
+
+    def _sent(self):
+        # called with inflight_lock held, once a spooled send knows its mid
+        self.sending -= 1
+        if not self.sending:
+            # the early acknowledgements left are those of unspooled messages
+            self.early_acks.clear()
+
+    def replay(self):
+        """Replay thread, sending the spooled messages after each (re)connection
+        """
+        while True:
+            self.replay_needed.wait()
+            self.replay_needed.clear()
+            if not self.running:
+                return
+
+            after_id = 0
+            replayed = 0
+            while self.running and self.connected.is_set():
+                rows = self.outbox.pending(after_id, self.replay_window)
+                if not rows:
+                    break
+                for row_id, topic, payload in rows:
+                    after_id = row_id
+                    with self.inflight_lock:
+                        if row_id in self.inflight.values():
+                            continue
+                    # keep the number of unacknowledged messages bounded
+                    while self.running and self.connected.is_set() and len(self.inflight) >= self.replay_window:
+                        time.sleep(0.05)
+                    if not (self.running and self.connected.is_set()):
+                        break
+                    self._send(row_id, topic, payload)
+                    replayed += 1
+                    time.sleep(1.0 / self.replay_rate)
+            if replayed:
+                logging.info(f'replayed {replayed} spooled messages')
+
+    def on_connect(self, client, userdata, flags, rc):
+        logging.debug('rc: ' + str(rc))
+        if rc == mqtt.CONNACK_ACCEPTED:
+            self.connected.set()
+            self.replay_needed.set()
+        else:
+            logging.error('mqtt connection refused: ' + mqtt.connack_string(rc))
+
+    def on_disconnect(self, client, userdata, rc):
+        self.connected.clear()
+        if rc != mqtt.MQTT_ERR_SUCCESS:
+            logging.warning('mqtt connection lost, reconnecting: ' + mqtt.error_string(rc))
+
+    def on_message(self, client, userdata, msg):
+        logging.debug(msg.topic + ' ' + str(msg.qos) + ' ' + str(msg.payload))
+
+    def on_publish(self, client, userdata, mid):
+        logging.debug('mid: ' + str(mid))
+        if self.outbox is None:
+            return
+
+        # called from the network thread, possibly before _send recorded the mid
+        now = time.monotonic()
+        with self.inflight_lock:
+            row_id = self.inflight.pop(mid, None)
+            sent = self.sent_at.pop(mid, None)
+            if row_id is None:
+                if self.sending:
+                    self.early_acks[mid] = now
+                return
+        metrics.registry.observe('collector_publish_latency_seconds', now - sent)
+        self.outbox.ack(row_id)
+
+    def on_subscribe(self, client, userdata, mid, granted_qos):
+        logging.debug('subscribed: ' + str(mid) + ' ' + str(granted_qos))
+
+    def on_socket_open(self, client, userdata, sock):
+        self._watch(self.loop.add_reader, sock.fileno(), client.loop_read)
+
+    def on_socket_close(self, client, userdata, sock):
+        self._watch(self.loop.remove_reader, sock.fileno())
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self._watch(self.loop.add_writer, sock.fileno(), client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self._watch(self.loop.remove_writer, sock.fileno())
+
+    def on_log(self, client, userdata, level, string):
+        logging.debug(string)
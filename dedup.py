@@ -0,0 +1,82 @@
+import collections
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+
+
+class DedupFilter(object):
+    """Suppresses datapoints identical to one already forwarded: points are
+    keyed by (topic, measurement, timestamp) and compared on a fingerprint
+    of their fields. Memory is bounded by max_entries (least recently seen
+    entries are evicted first) and entries not seen for window seconds
+    expire. With a path, the entries are saved on close and reloaded at
+    startup
+    """
+
+    def __init__(self, max_entries=None, window=None, path=None):
+        self.max_entries = max_entries or int(os.getenv('COLLECTOR_DEDUP_ENTRIES', 100000))
+        self.window = window or float(os.getenv('COLLECTOR_DEDUP_WINDOW', 86400))
+        self.path = path if path is not None else os.getenv('COLLECTOR_DEDUP_PATH')
+
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.stats = {}
+
+        if self.path and os.path.exists(self.path):
+            self.load()
+
+    def fingerprint(self, fields):
+        return zlib.crc32(repr(sorted(fields.items())).encode('utf-8'))
+
+    def accept(self, topic, point):
+        """Return True if the point must be forwarded, False if it is a duplicate
+        """
+        key = (topic, point['measurement'], point['timestamp'])
+        fingerprint = self.fingerprint(point['fields'])
+        now = time.time()
+
+        with self.lock:
+            stats = self.stats.get(topic)
+            if stats is None:
+                stats = self.stats[topic] = {'forwarded': 0, 'suppressed': 0}
+
+            entry = self.entries.pop(key, None)
+            self.entries[key] = (fingerprint, now)
+            duplicate = entry is not None and entry[0] == fingerprint and now - entry[1] < self.window
+            stats['suppressed' if duplicate else 'forwarded'] += 1
+            self._evict(now)
+            return not duplicate
+
+    def _evict(self, now):
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        # entries are ordered by last seen time, expired ones come first
+        while self.entries:
+            key, (_, seen) = next(iter(self.entries.items()))
+            if now - seen < self.window:
+                break
+            del self.entries[key]
+
+    def load(self):
+        with open(self.path) as f:
+            entries = json.load(f)
+        for topic, measurement, timestamp, fingerprint, seen in entries:
+            self.entries[(topic, measurement, timestamp)] = (fingerprint, seen)
+        self._evict(time.time())
+        logging.info(f'loaded {len(self.entries)} dedup entries from {self.path}')
+
+    def save(self):
+        with self.lock:
+            entries = [list(key) + list(value) for key, value in self.entries.items()]
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(entries, f)
+        os.replace(self.path + '.tmp', self.path)
+
+    def close(self):
+        for topic, stats in self.stats.items():
+            logging.info(f'dedup {topic}: {stats["forwarded"]} forwarded, {stats["suppressed"]} suppressed')
+        if self.path:
+            self.save()
@@ -0,0 +1,190 @@
+import json
+import os
+import struct
+
+# binary encoders write the fields of ColumnBuffer rows as float 64, and
+# their timestamps, past 1970-01-01 18:12, as uint 32
+pack_double = struct.Struct('>d').pack
+pack_uint32 = struct.Struct('>I').pack
+
+
+class JsonEncoder(object):
+    """Default encoder, a JSON list of {timestamp, measurement, fields} points
+    """
+
+    name = 'json'
+    content_type = 'application/json'
+    topic_suffix = ''
+    header_size = 2
+    separator_size = 1
+
+    def encode(self, point):
+        return json.dumps(point).encode('utf-8')
+
+    def encode_rows(self, buffer):
+        """Encode the rows of a ColumnBuffer, byte for byte like encode() of
+        the matching points but without building them
+        """
+        head = '{"timestamp": %d, "measurement": ' + json.dumps(buffer.measurement).replace('%', '%%') + ', "fields": {'
+        keys = [json.dumps(f) + ': ' for f in buffer.fields]
+        for row in buffer.rows():
+            fields = ', '.join(k + repr(v) for k, v in zip(keys, row[1:]) if v == v)
+            yield (head % row[0] + fields + '}}').encode('utf-8')
+
+    def join(self, encoded):
+        return b'[' + b','.join(encoded) + b']'
+
+
+class LineProtocolEncoder(object):
+    """InfluxDB line protocol, one line per point, timestamps in seconds
+    """
+
+    name = 'line'
+    content_type = 'application/x-influx-line-protocol; precision=s'
+    topic_suffix = '/lp'
+    header_size = 0
+    separator_size = 1
+
+    MEASUREMENT_ESCAPES = str.maketrans({',': '\\,', ' ': '\\ '})
+    KEY_ESCAPES = str.maketrans({',': '\\,', '=': '\\=', ' ': '\\ '})
+    STRING_ESCAPES = str.maketrans({'"': '\\"', '\\': '\\\\'})
+
+    def encode_value(self, value):
+        if isinstance(value, bool):
+            return 'true' if value else 'false'
+        if isinstance(value, int):
+            return f'{value}i'
+        if isinstance(value, float):
+            return repr(value)
+        return '"' + str(value).translate(self.STRING_ESCAPES) + '"'
+
+    def encode(self, point):
+        fields = ','.join(
+            k.translate(self.KEY_ESCAPES) + '=' + self.encode_value(v)
+            for k, v in point['fields'].items() if v is not None)
+        if not fields:
+            return None
+        line = point['measurement'].translate(self.MEASUREMENT_ESCAPES) + ' ' + fields + ' ' + str(point['timestamp'])
+        return line.encode('utf-8')
+
+    def encode_rows(self, buffer):
+        measurement = buffer.measurement.translate(self.MEASUREMENT_ESCAPES) + ' '
+        keys = [f.translate(self.KEY_ESCAPES) + '=' for f in buffer.fields]
+        for row in buffer.rows():
+            fields = ','.join(k + repr(v) for k, v in zip(keys, row[1:]) if v == v)
+            if fields:
+                yield (measurement + fields + ' ' + str(row[0])).encode('utf-8')
+
+    def join(self, encoded):
+        return b'\n'.join(encoded)
+
+
+class MsgPackEncoder(object):
+    """MessagePack array of points, needs the msgpack package
+    """
+
+    name = 'msgpack'
+    content_type = 'application/msgpack'
+    topic_suffix = '/msgpack'
+    header_size = 5
+    separator_size = 0
+
+    def __init__(self):
+        import msgpack
+        self.packb = msgpack.packb
+
+    def encode(self, point):
+        return self.packb(point)
+
+    def encode_rows(self, buffer):
+        """Encode the rows of a ColumnBuffer, byte for byte like encode() of
+        the matching points: the keys and the measurement are packed once,
+        the values are written straight from the arrays
+        """
+        head = b'\x83' + self.packb('timestamp')
+        middle = self.packb('measurement') + self.packb(buffer.measurement) + self.packb('fields')
+        keys = [self.packb(f) + b'\xcb' for f in buffer.fields]
+        for row in buffer.rows():
+            fields = [k + pack_double(v) for k, v in zip(keys, row[1:]) if v == v]
+            ts = b'\xce' + pack_uint32(row[0]) if 0x10000 <= row[0] < 0x100000000 else self.packb(row[0])
+            yield head + ts + middle + self.map_header(len(fields)) + b''.join(fields)
+
+    @staticmethod
+    def map_header(n):
+        if n < 16:
+            return struct.pack('B', 0x80 | n)
+        return struct.pack('>BH', 0xde, n)
+
+    def join(self, encoded):
+        n = len(encoded)
+        if n < 16:
+            header = struct.pack('B', 0x90 | n)
+        elif n < 0x10000:
+            header = struct.pack('>BH', 0xdc, n)
+        else:
+            header = struct.pack('>BI', 0xdd, n)
+        return header + b''.join(encoded)
+
+
+class CborEncoder(object):
+    """CBOR array of points, needs the cbor2 package
+    """
+
+    name = 'cbor'
+    content_type = 'application/cbor'
+    topic_suffix = '/cbor'
+    header_size = 9
+    separator_size = 0
+
+    def __init__(self):
+        import cbor2
+        self.dumps = cbor2.dumps
+
+    def encode(self, point):
+        return self.dumps(point)
+
+    def encode_rows(self, buffer):
+        """Encode the rows of a ColumnBuffer, byte for byte like encode() of
+        the matching points: the keys and the measurement are encoded once,
+        the values are written straight from the arrays
+        """
+        head = b'\xa3' + self.dumps('timestamp')
+        middle = self.dumps('measurement') + self.dumps(buffer.measurement) + self.dumps('fields')
+        keys = [self.dumps(f) + b'\xfb' for f in buffer.fields]
+        for row in buffer.rows():
+            fields = [k + pack_double(v) for k, v in zip(keys, row[1:]) if v == v]
+            ts = b'\x1a' + pack_uint32(row[0]) if 0x10000 <= row[0] < 0x100000000 else self.dumps(row[0])
+            yield head + ts + middle + self.map_header(len(fields)) + b''.join(fields)
+
+    @staticmethod
+    def map_header(n):
+        if n < 24:
+            return struct.pack('B', 0xa0 | n)
+        if n < 0x100:
+            return struct.pack('>BB', 0xb8, n)
+        return struct.pack('>BH', 0xb9, n)
+
+    def join(self, encoded):
+        n = len(encoded)
+        if n < 24:
+            header = struct.pack('B', 0x80 | n)
+        elif n < 0x100:
+            header = struct.pack('>BB', 0x98, n)
+        elif n < 0x10000:
+            header = struct.pack('>BH', 0x99, n)
+        else:
+            header = struct.pack('>BI', 0x9a, n)
+        return header + b''.join(encoded)
+
+
+ENCODERS = {e.name: e for e in (JsonEncoder, LineProtocolEncoder, MsgPackEncoder, CborEncoder)}
+
+
+def get_encoder(name=None):
+    """Return an encoder instance by name, defaulting to COLLECTOR_ENCODING (json)
+    """
+    if name is None:
+        name = os.getenv('COLLECTOR_ENCODING', JsonEncoder.name)
+    if name not in ENCODERS:
+        raise ValueError(f'unknown encoding {name}, expected one of {", ".join(ENCODERS)}')
+    return ENCODERS[name]()
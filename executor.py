@@ -0,0 +1,206 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+
+class PluginExecutor(object):
+    """Bounded thread pool running the plugin jobs. Each job key (plugin and
+    job function) has its own concurrency limit: ticks arriving while the
+    limit is reached are either skipped or coalesced into a single rerun
+    """
+
+    OVERLAP_SKIP = 'skip'
+    OVERLAP_COALESCE = 'coalesce'
+
+    def __init__(self, max_workers=None, max_queue=None):
+        if max_workers is None:
+            max_workers = int(os.getenv('COLLECTOR_WORKER_THREADS', 4))
+        if max_queue is None:
+            max_queue = int(os.getenv('COLLECTOR_MAX_QUEUE', 32))
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.slots = {}
+        self.stats = {}
+        # jobs in flight per plugin, what must run once none is left, and the
+        # plugins running it, whose jobs are held back meanwhile
+        self.active = {}
+        self.waiting = {}
+        self.blocked = set()
+
+    def _counters(self, key):
+        if key not in self.stats:
+            self.stats[key] = {
+                'submitted': 0,
+                'completed': 0,
+                'failed': 0,
+                'skipped': 0,
+                'coalesced': 0,
+                'rejected': 0,
+            }
+        return self.stats[key]
+
+    def submit(self, key, job_func, max_concurrency=1, overlap=OVERLAP_SKIP):
+        """Queue job_func for execution, unless key already has
+        max_concurrency runs in flight or the pool queue is full.
+        Returns True if the job was queued
+        """
+        with self.lock:
+            counters = self._counters(key)
+            slot = self.slots.setdefault(key, {'running': 0, 'pending': None})
+            plugin = key.partition('.')[0]
+
+            if plugin in self.blocked:
+                counters['coalesced'] += 1
+                slot['pending'] = (job_func, max_concurrency, overlap)
+                logging.debug(f'{key} held back while {plugin} is reconfigured')
+                return False
+
+            if slot['running'] >= max_concurrency:
+                if overlap == self.OVERLAP_COALESCE:
+                    counters['coalesced'] += 1
+                    slot['pending'] = (job_func, max_concurrency, overlap)
+                    logging.debug(f'{key} still running, coalescing tick')
+                else:
+                    counters['skipped'] += 1
+                    logging.debug(f'{key} still running, skipping tick')
+                return False
+
+            if self.queued >= self.max_queue:
+                counters['rejected'] += 1
+                logging.warning(f'executor queue full ({self.queued} jobs), rejecting {key}')
+                return False
+
+            counters['submitted'] += 1
+            slot['running'] += 1
+            self.queued += 1
+            self.active[plugin] = self.active.get(plugin, 0) + 1
+
+        self._dispatch(key, job_func)
+        return True
+
+    def _dispatch(self, key, job_func):
+        self.pool.submit(self._run, key, job_func)
+
+    def _run(self, key, job_func):
+        logging.debug(f'running {key} on thread {threading.current_thread().name}')
+        start = time.perf_counter()
+        failed = False
+        try:
+            if asyncio.iscoroutinefunction(job_func):
+                # coroutine job outside of the asyncio runtime, on its own loop
+                asyncio.run(job_func())
+            else:
+                job_func()
+        except Exception as ex:
+            failed = True
+            logging.exception(f'{key} failed: {ex}')
+        finally:
+            self._done(key, failed, time.perf_counter() - start)
+
+    def _done(self, key, failed, duration):
+        plugin, _, job = key.partition('.')
+        metrics.registry.observe('collector_job_duration_seconds', duration, plugin=plugin, job=job)
+        with self.lock:
+            counters = self._counters(key)
+            counters['failed' if failed else 'completed'] += 1
+            slot = self.slots[key]
+            slot['running'] -= 1
+            self.queued -= 1
+            pending, slot['pending'] = slot['pending'], None
+            self.active[plugin] -= 1
+            waiting = not self.active[plugin] and plugin in self.waiting
+            if waiting:
+                self.blocked.add(plugin)
+
+        if waiting:
+            self._run_blocked(plugin)
+        if pending is not None:
+            self.submit(key, *pending)
+
+    def between_runs(self, plugin, func):
+        """Call func while no job of plugin is running: right away when it
+        is idle, otherwise once its last running job finished, before the
+        next one starts. A func still waiting is replaced by a later one
+        """
+        with self.lock:
+            self.waiting[plugin] = func
+            if self.active.get(plugin) or plugin in self.blocked:
+                return
+            self.blocked.add(plugin)
+        self._run_blocked(plugin)
+
+    def _run_blocked(self, plugin):
+        """Call the waiting funcs of plugin, outside of the lock but with its
+        jobs held back, then submit the ticks held back meanwhile
+        """
+        while True:
+            with self.lock:
+                func = self.waiting.pop(plugin, None)
+                if func is None:
+                    self.blocked.discard(plugin)
+                    held = [(k, s['pending']) for k, s in self.slots.items()
+                            if k.partition('.')[0] == plugin and s['pending'] is not None and not s['running']]
+                    for key, _ in held:
+                        self.slots[key]['pending'] = None
+                    break
+            try:
+                func()
+            except Exception as ex:
+                logging.exception(f'{func} failed: {ex}')
+
+        for key, pending in held:
+            self.submit(key, *pending)
+
+    def shutdown(self, wait=True):
+        """Stop accepting jobs and wait for the running ones to finish
+        """
+        self.pool.shutdown(wait=wait)
+
+
+class AsyncExecutor(PluginExecutor):
+    """PluginExecutor of the asyncio runtime: coroutine jobs run as tasks of
+    the event loop while plain jobs keep running on the thread pool. Both
+    share the same concurrency limits, queue bound and counters
+    """
+
+    def __init__(self, loop, max_workers=None, max_queue=None):
+        super().__init__(max_workers, max_queue)
+        self.loop = loop
+        self.futures = set()
+
+    def _dispatch(self, key, job_func):
+        if not asyncio.iscoroutinefunction(job_func):
+            return super()._dispatch(key, job_func)
+
+        # submit() is called from the loop by the scheduler, but coalesced
+        # reruns of thread pool jobs come from the worker threads
+        future = asyncio.run_coroutine_threadsafe(self._run_async(key, job_func), self.loop)
+        self.futures.add(future)
+        future.add_done_callback(self.futures.discard)
+
+    async def _run_async(self, key, job_func):
+        logging.debug(f'running {key} on the event loop')
+        start = time.perf_counter()
+        failed = False
+        try:
+            await job_func()
+        except Exception as ex:
+            failed = True
+            logging.exception(f'{key} failed: {ex}')
+        finally:
+            self._done(key, failed, time.perf_counter() - start)
+
+    async def join(self):
+        """Wait for the coroutine jobs in flight to finish
+        """
+        while self.futures:
+            await asyncio.wait([asyncio.wrap_future(f) for f in list(self.futures)])
@@ -0,0 +1,282 @@
+import asyncio
+import functools
+import importlib.util
+import json
+import logging
+import os
+import random
+import ssl
+import threading
+import time
+import urllib.parse
+
+import metrics
+
+
+def aiohttp_available():
+    return importlib.util.find_spec('aiohttp') is not None
+
+
+class BaseHttpClient(object):
+    """Timeouts, retry policy and per host stats shared by the clients.
+    Only idempotent methods are retried by default, a POST is retried when
+    the caller passes retry=True (a login or a quota counted call must not
+    be sent twice)
+    """
+
+    IDEMPOTENT = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+    def __init__(self, timeout=None, retries=None, backoff=None, pool_size=4):
+        if timeout is None:
+            timeout = (
+                float(os.getenv('COLLECTOR_HTTP_CONNECT_TIMEOUT', 5)),
+                float(os.getenv('COLLECTOR_HTTP_READ_TIMEOUT', 30)))
+        self.timeout = timeout
+        self.retries = int(os.getenv('COLLECTOR_HTTP_RETRIES', 3)) if retries is None else retries
+        self.backoff = float(os.getenv('COLLECTOR_HTTP_BACKOFF', 0.5)) if backoff is None else backoff
+        self.max_backoff = 30
+        self.pool_size = pool_size
+        # name of the plugin owning the client, labelling its metrics
+        self.name = None
+
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def _retries(self, method, retry):
+        if retry is None:
+            retry = method.upper() in self.IDEMPOTENT
+        return self.retries if retry else 0
+
+    def _delay(self, attempt):
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def _record(self, host, latency, sent=0, received=0, error=False, retry=False):
+        with self.lock:
+            stats = self.stats.get(host)
+            if stats is None:
+                stats = self.stats[host] = {
+                    'requests': 0,
+                    'errors': 0,
+                    'retries': 0,
+                    'latency': 0.0,
+                    'latency_max': 0.0,
+                    'bytes_sent': 0,
+                    'bytes_received': 0,
+                }
+            if retry:
+                stats['retries'] += 1
+                return
+            metrics.registry.observe('collector_http_request_duration_seconds', latency, plugin=self.name or '', host=host)
+
+            stats['requests'] += 1
+            stats['latency'] += latency
+            stats['latency_max'] = max(stats['latency_max'], latency)
+            if error:
+                stats['errors'] += 1
+            stats['bytes_sent'] += sent
+            stats['bytes_received'] += received
+
+
+class HttpClient(BaseHttpClient):
+    """HTTP client shared by the jobs of a plugin: a requests.Session keeping
+    one connection pool per host, default connect/read timeouts and retries
+    with exponential backoff and jitter on timeouts, connection errors and
+    5xx responses. Latency and bytes are counted per host in stats. The
+    session, and requests, are only loaded on first use
+    """
+
+    def __init__(self, timeout=None, retries=None, backoff=None, pool_size=4):
+        super().__init__(timeout, retries, backoff, pool_size)
+        # sent with every request, on top of the session defaults
+        self.headers = {}
+        self.verify = True
+        self._session = None
+
+    @property
+    def session(self):
+        with self.lock:
+            if self._session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+
+                self._session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+                self._session.mount('http://', adapter)
+                self._session.mount('https://', adapter)
+            return self._session
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def request(self, method, url, retry=None, **kwargs):
+        """Send a request through the pooled session, retrying failures
+        """
+        import requests
+
+        session = self.session
+        retries = self._retries(method, retry)
+        kwargs.setdefault('timeout', self.timeout)
+        kwargs.setdefault('verify', self.verify)
+        kwargs['headers'] = {**self.headers, **(kwargs.get('headers') or {})}
+        host = urllib.parse.urlsplit(url).netloc
+
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                r = session.request(method, url, **kwargs)
+            except (requests.Timeout, requests.ConnectionError) as ex:
+                self._record(host, time.perf_counter() - start, error=True)
+                if attempt >= retries:
+                    raise
+                logging.warning(f'{method} {url} failed ({ex}), retrying')
+            else:
+                if kwargs.get('stream'):
+                    received = int(r.headers.get('Content-Length', 0))
+                else:
+                    received = len(r.content)
+                self._record(host, time.perf_counter() - start, sent=len(r.request.body or b''),
+                             received=received, error=r.status_code >= 500)
+                if r.status_code < 500 or attempt >= retries:
+                    return r
+                logging.warning(f'{method} {url} returned {r.status_code}, retrying')
+                # hand the connection of a streamed response back to the pool
+                r.close()
+
+            self._record(host, 0, retry=True)
+            time.sleep(self._delay(attempt))
+            attempt += 1
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+
+
+class Response(object):
+    """Answer of AsyncHttpClient, read in full, with the attributes of
+    requests.Response the plugins rely on
+    """
+
+    def __init__(self, url, status_code, headers, content):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', 'replace')
+
+    def json(self, **kwargs):
+        return json.loads(self.content, **kwargs)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            import requests
+            raise requests.HTTPError(f'{self.status_code} for url: {self.url}', response=self)
+
+
+class AsyncHttpClient(BaseHttpClient):
+    """aiohttp counterpart of HttpClient for the coroutine jobs of the asyncio
+    runtime, with the same timeouts, retries and stats. The session is
+    opened on first use, from the running event loop. Needs aiohttp
+    """
+
+    def __init__(self, timeout=None, retries=None, backoff=None, pool_size=4):
+        import aiohttp
+        self.aiohttp = aiohttp
+
+        super().__init__(timeout, retries, backoff, pool_size)
+        self.headers = {}
+        self.verify = True
+        self.session = None
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request('POST', url, **kwargs)
+
+    async def request(self, method, url, retry=None, **kwargs):
+        """Send a request through the pooled session, retrying failures
+        """
+        retries = self._retries(method, retry)
+        if self.session is None:
+            self.session = self.aiohttp.ClientSession(
+                    connector=self.aiohttp.TCPConnector(limit_per_host=self.pool_size),
+                    timeout=self._timeout(self.timeout))
+        if 'timeout' in kwargs:
+            kwargs['timeout'] = self._timeout(kwargs['timeout'])
+        kwargs['headers'] = {**self.headers, **kwargs.get('headers', {})}
+        kwargs.setdefault('ssl', self._ssl())
+        host = urllib.parse.urlsplit(url).netloc
+
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                async with self.session.request(method, url, **kwargs) as r:
+                    content = await r.read()
+            except (asyncio.TimeoutError, self.aiohttp.ClientConnectionError) as ex:
+                self._record(host, time.perf_counter() - start, error=True)
+                if attempt >= retries:
+                    raise
+                logging.warning(f'{method} {url} failed ({ex}), retrying')
+            else:
+                sent = kwargs.get('data')
+                self._record(host, time.perf_counter() - start, sent=len(sent) if isinstance(sent, (bytes, str)) else 0,
+                             received=len(content), error=r.status >= 500)
+                if r.status < 500 or attempt >= retries:
+                    return Response(str(r.url), r.status, r.headers, content)
+                logging.warning(f'{method} {url} returned {r.status}, retrying')
+
+            self._record(host, 0, retry=True)
+            await asyncio.sleep(self._delay(attempt))
+            attempt += 1
+
+    def _timeout(self, timeout):
+        # requests style timeout: seconds, or a (connect, read) tuple
+        if isinstance(timeout, self.aiohttp.ClientTimeout):
+            return timeout
+        connect, read = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+        return self.aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+
+    def _ssl(self):
+        # same meaning as requests verify: a flag or a CA bundle path
+        if isinstance(self.verify, str):
+            return ssl.create_default_context(cafile=self.verify)
+        return bool(self.verify)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+
+class ThreadedHttpClient(object):
+    """Awaitable facade of an HttpClient, running its blocking requests on
+    the default executor of the event loop. Used by coroutine jobs when
+    aiohttp is not installed
+    """
+
+    def __init__(self, http):
+        self.http = http
+
+    @property
+    def stats(self):
+        return self.http.stats
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request('POST', url, **kwargs)
+
+    async def request(self, method, url, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(self.http.request, method, url, **kwargs))
+
+    async def close(self):
+        pass
@@ -0,0 +1,228 @@
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# upper bounds (seconds) of the histogram buckets, +Inf being implicit
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+HELP = {
+    'collector_job_duration_seconds': 'Duration of the plugin job runs',
+    'collector_jobs_total': 'Plugin job ticks, by outcome',
+    'collector_scheduler_lateness_seconds': 'Delay between the planned and the actual start of the jobs',
+    'collector_http_request_duration_seconds': 'Latency of the http requests of the plugins',
+    'collector_http_requests_total': 'Http requests of the plugins',
+    'collector_http_errors_total': 'Http requests failed or answered with a 5xx status',
+    'collector_http_retries_total': 'Http requests retried',
+    'collector_http_received_bytes_total': 'Http response bytes received',
+    'collector_points_total': 'Datapoints emitted by the plugins',
+    'collector_dedup_points_total': 'Datapoints checked by the dedup filter, by result',
+    'collector_published_messages_total': 'MQTT messages published',
+    'collector_published_bytes_total': 'MQTT payload bytes published',
+    'collector_publish_failures_total': 'MQTT publish calls that failed',
+    'collector_publish_latency_seconds': 'Time from publish to the broker acknowledgement of spooled messages',
+    'collector_outbox_messages': 'Messages waiting in the outbox',
+    'collector_outbox_evicted_total': 'Messages evicted from the full outbox',
+}
+
+
+class Histogram(object):
+    """Bucketed distribution of observed values, with their count and sum
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self):
+        """Cumulative counts per upper bound, as exposed by Prometheus
+        """
+        cumulative = {}
+        total = 0
+        for bound, count in zip(list(self.buckets) + ['+Inf'], self.counts):
+            total += count
+            cumulative[str(bound)] = total
+        return {'count': self.count, 'sum': self.sum, 'buckets': cumulative}
+
+
+class MetricsRegistry(object):
+    """Thread safe registry of counters, gauges and histograms, each series
+    identified by a metric name and its labels. Components already keeping
+    their own counters register a collector instead, called on each export
+    and returning (kind, name, labels, value) tuples
+    """
+
+    COUNTER = 'counter'
+    GAUGE = 'gauge'
+    HISTOGRAM = 'histogram'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+        self.collectors = []
+
+    def _series(self, kind, name, labels):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = {'kind': kind, 'series': {}}
+        return metric['series'], tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            series, key = self._series(self.COUNTER, name, labels)
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            series, key = self._series(self.GAUGE, name, labels)
+            series[key] = value
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS, **labels):
+        with self.lock:
+            series, key = self._series(self.HISTOGRAM, name, labels)
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def collect(self):
+        """Return {name: (kind, [(labels, value)])}, histogram values being
+        their snapshot
+        """
+        families = {}
+        with self.lock:
+            for name, metric in self.metrics.items():
+                families[name] = (metric['kind'], [
+                    (dict(key), value.snapshot() if isinstance(value, Histogram) else value)
+                    for key, value in metric['series'].items()])
+
+        for collector in self.collectors:
+            try:
+                samples = list(collector())
+            except Exception as ex:
+                logging.warning(f'metrics collector failed: {ex}')
+                continue
+            for kind, name, labels, value in samples:
+                families.setdefault(name, (kind, []))[1].append((labels, value))
+        return families
+
+    def to_json(self):
+        families = self.collect()
+        return json.dumps({
+            'timestamp': int(time.time()),
+            'metrics': {
+                name: [{'labels': labels, 'value': value} for labels, value in series]
+                for name, (_, series) in sorted(families.items())
+            },
+        })
+
+    def to_prometheus(self):
+        """Prometheus text exposition format (version 0.0.4)
+        """
+        lines = []
+        for name, (kind, series) in sorted(self.collect().items()):
+            if name in HELP:
+                lines.append(f'# HELP {name} {HELP[name]}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in series:
+                if kind != self.HISTOGRAM:
+                    lines.append(f'{name}{format_labels(labels)} {value}')
+                    continue
+                for bound, count in value['buckets'].items():
+                    lines.append(f'{name}_bucket{format_labels(dict(labels, le=bound))} {count}')
+                lines.append(f'{name}_sum{format_labels(labels)} {value["sum"]}')
+                lines.append(f'{name}_count{format_labels(labels)} {value["count"]}')
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for k, v in sorted(labels.items()))
+    return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+
+# registry shared by all the components of the collector
+registry = MetricsRegistry()
+
+
+class MetricsReporter(object):
+    """Publishes the registry as JSON on the metrics topic every interval
+    seconds and, when a port is configured, serves it in the Prometheus
+    format on http://addr:port/metrics
+    """
+
+    def __init__(self, mqtt, registry=registry, topic=None, interval=None, port=None, addr=None):
+        self.mqtt = mqtt
+        self.registry = registry
+        self.topic = topic or os.getenv('COLLECTOR_METRICS_TOPIC', '$collector/metrics')
+        self.interval = interval or float(os.getenv('COLLECTOR_METRICS_INTERVAL', 60))
+        self.port = port if port is not None else int(os.getenv('COLLECTOR_METRICS_PORT', 0))
+        self.addr = addr or os.getenv('COLLECTOR_METRICS_ADDR', '127.0.0.1')
+
+        self.stopped = threading.Event()
+        self.thread = None
+        self.server = None
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name='metrics', daemon=True)
+        self.thread.start()
+
+        if self.port:
+            self.server = ThreadingHTTPServer((self.addr, self.port), self.handler())
+            self.server.daemon_threads = True
+            threading.Thread(target=self.server.serve_forever, name='metrics-http', daemon=True).start()
+            logging.info(f'serving metrics on http://{self.addr}:{self.port}/metrics')
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.publish()
+
+    def publish(self):
+        # metrics are only worth their latest value, they skip the outbox
+        self.mqtt.publish(self.topic, self.registry.to_json(), spool=False)
+
+    def handler(self):
+        registry = self.registry
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.to_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug('metrics http: ' + format % args)
+
+        return MetricsHandler
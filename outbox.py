@@ -0,0 +1,109 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+
+class Outbox(object):
+    """Disk backed store-and-forward spool. Each message is stored before
+    being published and deleted once the broker acknowledged it (QoS 1), so
+    what could not be delivered survives broker outages and restarts.
+    The spool is capped to max_bytes of payload, evicting either the oldest
+    messages or the incoming one. Entry points other than the collector
+    pass a name, their spool is then a file of its own next to the
+    collector one (e.g. outbox-tester.sqlite), so that they never replay
+    the messages of a running collector
+    """
+
+    EVICT_OLDEST = 'oldest'
+    EVICT_NEWEST = 'newest'
+
+    def __init__(self, path=None, max_bytes=None, eviction=None, name=None):
+        if path is None:
+            path = os.getenv('COLLECTOR_OUTBOX_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'outbox.sqlite'))
+            if name is not None:
+                root, ext = os.path.splitext(path)
+                path = f'{root}-{name}{ext}'
+        self.path = path
+        self.max_bytes = max_bytes or int(os.getenv('COLLECTOR_OUTBOX_MAX_BYTES', 64 * 1024 * 1024))
+        self.eviction = eviction or os.getenv('COLLECTOR_OUTBOX_EVICTION', self.EVICT_OLDEST)
+
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS messages ('
+            ' id INTEGER PRIMARY KEY AUTOINCREMENT,'
+            ' topic TEXT NOT NULL,'
+            ' payload BLOB NOT NULL,'
+            ' created REAL NOT NULL)')
+        self.size = self.db.execute('SELECT COALESCE(SUM(LENGTH(payload)), 0) FROM messages').fetchone()[0]
+        self.evicted = 0
+
+        pending = self.count()
+        if pending:
+            logging.info(f'outbox {path} holds {pending} messages ({self.size} bytes) to replay')
+
+    def put(self, topic, payload):
+        """Store a message, returns its id or None if it was evicted
+        """
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+
+        with self.lock:
+            if self.size + len(payload) > self.max_bytes:
+                if self.eviction == self.EVICT_NEWEST:
+                    self.evicted += 1
+                    logging.warning(f'outbox full ({self.size} bytes), dropping message for {topic}')
+                    return None
+                self._evict_oldest(self.size + len(payload) - self.max_bytes)
+
+            cursor = self.db.execute(
+                'INSERT INTO messages (topic, payload, created) VALUES (?, ?, ?)',
+                (topic, payload, time.time()))
+            self.size += len(payload)
+            return cursor.lastrowid
+
+    def _evict_oldest(self, needed):
+        freed = 0
+        rows = self.db.execute('SELECT id, LENGTH(payload) FROM messages ORDER BY id')
+        last = None
+        count = 0
+        for row_id, length in rows:
+            if freed >= needed:
+                break
+            freed += length
+            last = row_id
+            count += 1
+        if last is not None:
+            self.db.execute('DELETE FROM messages WHERE id <= ?', (last,))
+            self.size -= freed
+            self.evicted += count
+            logging.warning(f'outbox full, evicted {count} oldest messages ({freed} bytes)')
+
+    def ack(self, row_id):
+        """Delete a message acknowledged by the broker
+        """
+        with self.lock:
+            row = self.db.execute('SELECT LENGTH(payload) FROM messages WHERE id = ?', (row_id,)).fetchone()
+            if row is not None:
+                self.db.execute('DELETE FROM messages WHERE id = ?', (row_id,))
+                self.size -= row[0]
+
+    def pending(self, after_id=0, limit=100):
+        """Return up to limit stored messages (id, topic, payload) with an id above after_id
+        """
+        with self.lock:
+            return self.db.execute(
+                'SELECT id, topic, payload FROM messages WHERE id > ? ORDER BY id LIMIT ?',
+                (after_id, limit)).fetchall()
+
+    def count(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,168 @@
+import codecs
+import importlib.util
+import json
+
+# Plugins turn api answers into points through generators, so that every
+# point flows on its own from the socket to the broker:
+#
+#   fetch      http request with stream=True, body read chunk by chunk
+#   parse      response_items() yields the elements of one array of the body
+#   transform  plugin generator turning each element into points
+#   encode     BatchPublisher.add() encodes each point into its batch
+#   publish    full batches go out, see Plugin.emit_all()
+#
+# No stage holds more than a chunk of the body, one element and the batches
+# being filled, whatever the size of the answer.
+
+CHUNK_SIZE = 65536
+
+
+def ijson_available():
+    return importlib.util.find_spec('ijson') is not None
+
+
+class ChunkReader(object):
+    """File-like read() over an iterable of bytes chunks, for ijson
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.pending = b''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.pending) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.pending += chunk
+        if size < 0:
+            size = len(self.pending)
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+
+class ItemScanner(object):
+    """Fallback incremental parser when ijson is not installed: it walks down
+    the object keys of the prefix, skipping the other values, then decodes
+    the elements of the array one at a time with JSONDecoder.raw_decode(),
+    reading more chunks whenever the buffer ends within a value
+    """
+
+    WHITESPACE = ' \t\n\r'
+    DELIMITERS = WHITESPACE + ',:]}'
+
+    def __init__(self, chunks, prefix):
+        keys = prefix.split('.')
+        if keys[-1] != 'item':
+            raise ValueError(f'unsupported prefix {prefix}, it must name an array (...item)')
+        self.keys = keys[:-1]
+        self.chunks = iter(chunks)
+        self.decode = codecs.getincrementaldecoder('utf-8')().decode
+        self.decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.exhausted = False
+
+    def fill(self):
+        """Append the next chunk to the buffer, False at the end of the body
+        """
+        if self.exhausted:
+            return False
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.exhausted = True
+            self.buf += self.decode(b'', final=True)
+            return False
+        self.buf = self.buf[self.pos:] + self.decode(chunk)
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Next non blank character, None at the end of the body
+        """
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in self.WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return None
+
+    def expect(self, chars):
+        c = self.peek()
+        if c is None or c not in chars:
+            raise ValueError(f'expecting one of {chars!r}, got {c!r}')
+        self.pos += 1
+        return c
+
+    def value(self):
+        """Decode the value at the current position, reading more of the body
+        until it is complete: a number is only complete once followed by a
+        delimiter, "12" may be the start of "12.5"
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                if self.exhausted or (end < len(self.buf) and self.buf[end] in self.DELIMITERS):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.exhausted:
+                    raise
+            self.fill()
+
+    def seek(self):
+        """Move to the first element of the array, False when the body has no
+        such array
+        """
+        for key in self.keys:
+            self.expect('{')
+            while True:
+                if self.peek() == '}':
+                    return False
+                name = self.value()
+                self.expect(':')
+                if name == key:
+                    break
+                self.value()
+                if self.expect(',}') == '}':
+                    return False
+        self.expect('[')
+        return True
+
+    def __iter__(self):
+        if not self.seek():
+            return
+        if self.peek() == ']':
+            return
+        while True:
+            yield self.value()
+            if self.expect(',]') == ']':
+                return
+
+
+def iter_items(chunks, prefix):
+    """Yield the elements of the array at prefix (ijson syntax, object keys
+    followed by item, e.g. 'meter_reading.interval_reading.item') of the
+    JSON document made of the bytes chunks
+    """
+    if ijson_available():
+        import ijson
+        return ijson.items(ChunkReader(chunks), prefix, use_float=True)
+    return iter(ItemScanner(chunks, prefix))
+
+
+def response_items(r, prefix):
+    """Elements of the array at prefix of a response body, streamed when the
+    request was sent with stream=True
+    """
+    if hasattr(r, 'iter_content'):
+        chunks = r.iter_content(CHUNK_SIZE)
+    else:
+        chunks = [r.content]
+    try:
+        yield from iter_items(chunks, prefix)
+    finally:
+        if hasattr(r, 'close'):
+            r.close()
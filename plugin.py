@@ -1,13 +1,80 @@
-import inspect
-import json
+import ast
+import asyncio
+import functools
+import importlib
 import logging
 import os
-import pkgutil
 import sys
-import threading
 import time
 
-import paho.mqtt.client as mqtt
+from aggregator import Aggregator
+from configstore import store
+from connection import MqttConnection
+from dedup import DedupFilter
+from executor import AsyncExecutor, PluginExecutor
+from httpclient import AsyncHttpClient, HttpClient, ThreadedHttpClient, aiohttp_available
+from metrics import MetricsReporter, registry
+from outbox import Outbox
+from publisher import BatchPublisher
+from scheduler import AsyncScheduler, EventScheduler
+
+
+def scan_plugin_module(path):
+    """Statically scan a python file for classes deriving from Plugin and
+    return their manifest (class, name and active flag set in __init__)
+    """
+    with open(path) as f:
+        tree = ast.parse(f.read(), filename=path)
+
+    manifests = []
+    for node in tree.body:
+        if not isinstance(node, ast.ClassDef):
+            continue
+        bases = [b.attr if isinstance(b, ast.Attribute) else getattr(b, 'id', None) for b in node.bases]
+        if 'Plugin' not in bases:
+            continue
+
+        manifest = {'class': node.name, 'name': None, 'active': False}
+        for item in node.body:
+            if not (isinstance(item, ast.FunctionDef) and item.name == '__init__'):
+                continue
+            for stmt in ast.walk(item):
+                if not (isinstance(stmt, ast.Assign) and isinstance(stmt.value, ast.Constant)):
+                    continue
+                for target in stmt.targets:
+                    if (isinstance(target, ast.Attribute) and isinstance(target.value, ast.Name)
+                            and target.value.id == 'self' and target.attr in ('name', 'active')):
+                        manifest[target.attr] = stmt.value.value
+        if manifest['name'] is None:
+            manifest['name'] = os.path.splitext(os.path.basename(path))[0]
+        manifests.append(manifest)
+    return manifests
+
+
+def walk_plugins(package, manifest=None, seen_paths=None):
+    """Recursively walk the supplied package and statically scan its modules,
+    returning the manifest of the plugins found, without importing anything
+    """
+    manifest = [] if manifest is None else manifest
+    seen_paths = [] if seen_paths is None else seen_paths
+    imported_package = __import__(package, fromlist=['blah'])
+
+    for pkg_path in imported_package.__path__:
+        if pkg_path in seen_paths:
+            continue
+        seen_paths.append(pkg_path)
+
+        for entry in sorted(os.listdir(pkg_path)):
+            path = os.path.join(pkg_path, entry)
+            if os.path.isdir(path):
+                if not entry.startswith(('.', '__')):
+                    walk_plugins(package + '.' + entry, manifest, seen_paths)
+            elif entry.endswith('.py'):
+                for found in scan_plugin_module(path):
+                    found['module'] = package + '.' + entry[:-3]
+                    logging.debug(f'found plugin class: {found["module"]}.{found["class"]}')
+                    manifest.append(found)
+    return manifest
 
 
 class Plugin(object):
@@ -15,34 +82,75 @@ class Plugin(object):
     you must define the methods that all of your plugins must implement
     """
 
-    def __init__(self):
+    def __init__(self, http_options=None):
         self.active = False
         self.name = None
         self.version = None
         self.description = None
         self.mqtt_topic = None
+        self.mqtt = None
+        self.publisher = None
+
+        # plugins republishing overlapping windows set this to drop the points
+        # already published unchanged (can be overridden in config.json)
+        self.deduplicate = False
+        self.dedup = None
+
+        # fields of the points that are cumulative counters, their rate is
+        # computed when the points are aggregated (see Aggregator)
+        self.counters = ()
+        self.aggregator = None
+
+        # at most max_concurrency runs of a job in flight, extra ticks are
+        # either skipped or coalesced into one rerun (see PluginExecutor)
+        self.executor = None
+        self.max_concurrency = 1
+        self.overlap = PluginExecutor.OVERLAP_SKIP
+
+        # pooled http client with default timeouts and retries, unless set
+        # in http_options, and its awaitable counterpart for coroutine jobs
+        # (set by PluginCollection)
+        self.http = HttpClient(**(http_options or {}))
+        self.ahttp = None
+
+        # plugins able to fetch history set the longest date range a single
+        # backfill() call may cover, and how many chunks to fetch at once
+        self.backfill_chunk = None
+        self.backfill_workers = 1
 
         self.config_load()
 
+    def plugin_file(self, name):
+        """Path of a file stored next to the plugin module, like its config.json,
+        or in a directory named after the plugin package under COLLECTOR_CONFIG_DIR
+        """
+        dir = os.path.dirname(sys.modules[self.__class__.__module__].__file__)
+        config_dir = os.getenv('COLLECTOR_CONFIG_DIR')
+        if config_dir:
+            return os.path.join(config_dir, os.path.basename(dir), name)
+        return os.path.join(dir, name)
+
     def config_load(self):
-        dir = sys.modules[self.__class__.__module__].__file__
-        file = os.path.join(os.path.dirname(dir), 'config.json')
-        # logging.debug(f'reading config from {file}')
-        if os.path.exists(file):
-            self.config = json.load(open(file))
-        else:
-            self.config = {}
-        # logging.debug('config=' + json.dumps(self.config))
+        self.config = store.load(self.plugin_file('config.json'))
 
     def config_save(self):
-        dir = sys.modules[self.__class__.__module__].__file__
-        file = os.path.join(os.path.dirname(dir), 'config.json')
-        json.dump(self.config, open(file, 'w'))
+        store.save(self.plugin_file('config.json'), self.config)
+
+    def configure(self):
+        """Apply the settings read from self.config. Plugins call it at the
+        end of their __init__, it is called again when config.json changes
+        """
+
+    def reconfigure(self, config):
+        self.config = config
+        self.configure()
 
     def run_threaded(self, job_func):
-        logging.debug('running on thread {}'.format(threading.current_thread()))
-        job_thread = threading.Thread(target=job_func)
-        job_thread.start()
+        self.executor.submit(
+                f'{self.name}.{job_func.__name__}',
+                job_func,
+                max_concurrency=self.max_concurrency,
+                overlap=self.overlap)
 
     def scheduler(self, **options):
         """This method returns a scheduler, ready to be called
@@ -50,43 +158,52 @@ class Plugin(object):
         raise NotImplementedError
 
     def job(self):
-        """This method execute the job of the plugin
+        """This method execute the job of the plugin, it may be a coroutine
+        function (async def), run on the event loop by the asyncio runtime
         """
         raise NotImplementedError
 
-    def mqtt_on_connect(self, mqttc, obj, flags, rc):
-        logging.debug('rc: ' + str(rc))
-
-    def mqtt_on_message(self, mqttc, obj, msg):
-        logging.debug(msg.topic + ' ' + str(msg.qos) + ' ' + str(msg.payload))
-
-    def mqtt_on_publish(self, mqttc, obj, mid):
-        logging.debug('mid: ' + str(mid))
-        pass
-
-    def mqtt_on_subscribe(self, mqttc, obj, mid, granted_qos):
-        logging.debug('subscribed: ' + str(mid) + ' ' + str(granted_qos))
-
-    def mqtt_on_log(self, mqttc, obj, level, string):
-        logging.debug(string)
-
-    def get_mqtt_client(self, app_id):
-        mqtt_client = mqtt.Client(app_id)
+    def backfill(self, start, end):
+        """Fetch and emit the history from day start to day end included, at
+        most backfill_chunk long (see backfill.py)
+        """
+        raise NotImplementedError
 
-        mqtt_client.on_message = self.mqtt_on_message
-        mqtt_client.on_connect = self.mqtt_on_connect
-        mqtt_client.on_publish = self.mqtt_on_publish
-        mqtt_client.on_subscribe = self.mqtt_on_subscribe
-        mqtt_client.on_log = self.mqtt_on_log
+    def publish(self, payload, qos=0):
+        """Publish payload on the plugin topic through the shared connection
+        """
+        return self.mqtt.publish(self.mqtt_topic, payload, qos=qos)
 
-        mqtt_client.username_pw_set(
-                os.getenv('COLLECTOR_MQTT_USER', 'sysadmin'),
-                os.getenv('COLLECTOR_MQTT_PASS', 'sysadmin'))
-        mqtt_client.connect(
-                os.getenv('COLLECTOR_MQTT_HOST', 'localhost'),
-                port=os.getenv('COLLECTOR_MQTT_PORT', 1883))
+    def emit(self, point):
+        """Hand one {timestamp, measurement, fields} datapoint to the batching
+        publisher, it goes out in a list payload on the plugin topic
+        """
+        registry.inc('collector_points_total', plugin=self.name)
+        if self.dedup is not None and not self.dedup.accept(self.mqtt_topic, point):
+            return
+        if self.aggregator is not None:
+            self.aggregator.add(self.mqtt_topic, point)
+            return
+        self.publisher.add(self.mqtt_topic, point)
+
+    def emit_buffer(self, buffer):
+        """Hand the rows of a ColumnBuffer to the batching publisher, encoded
+        straight from its arrays. Rows are not deduplicated: plugins using
+        buffers only emit rows they did not emit before (e.g. past a cursor)
+        """
+        registry.inc('collector_points_total', len(buffer), plugin=self.name)
+        self.publisher.add_buffer(self.mqtt_topic, buffer)
 
-        return mqtt_client
+    def emit_all(self, points):
+        """Emit the points of an iterable as they are produced, so that a
+        generator pipeline (see pipeline.py) never holds them all, returns
+        how many were emitted
+        """
+        count = 0
+        for point in points:
+            self.emit(point)
+            count += 1
+        return count
 
 
 class PluginCollection(object):
@@ -94,81 +211,217 @@ class PluginCollection(object):
     that contain a class definition that is inheriting from the Plugin class
     """
 
-    def __init__(self, plugin_package, filter_by_names=None):
+    def __init__(self, plugin_package, filter_by_names=None, mqtt=None):
         """Constructor that initiates the reading of all available plugins
-        when an instance of the PluginCollection object is created
+        when an instance of the PluginCollection object is created. The
+        plugins publish through mqtt, by default a new spooled MqttConnection
         """
         self.plugin_package = plugin_package
 
-        self.plugins = []
-        self.seen_paths = []
         logging.info('looking for plugins')
-        self.walk(self.plugin_package)
+        self.manifest = walk_plugins(self.plugin_package)
 
-        if not (filter_by_names is None):
-            self.plugins = [p for p in self.plugins if p.name in filter_by_names]
+        # only import and build the selected plugins, or the active ones
+        if filter_by_names is None:
+            selected = [m for m in self.manifest if m['active']]
+        else:
+            selected = [m for m in self.manifest if m['name'] in filter_by_names]
+
+        self.timings = {}
+        self.plugins = [self.load(m) for m in selected]
+
+        self.mqtt = mqtt or MqttConnection(outbox=Outbox())
+        self.publisher = BatchPublisher(self.mqtt)
+        self.dedup = DedupFilter()
+        self.aggregator = Aggregator(self.publisher)
+        self.executor = PluginExecutor()
+        self.scheduler = EventScheduler()
+        self.metrics = MetricsReporter(self.mqtt)
+        registry.add_collector(self.collect_metrics)
+        for plugin in self.plugins:
+            plugin.mqtt = self.mqtt
+            plugin.publisher = self.publisher
+            plugin.executor = self.executor
+            plugin.http.name = plugin.name
+            plugin.ahttp = ThreadedHttpClient(plugin.http)
+            self.apply_config(plugin)
+            store.watch(plugin.plugin_file('config.json'), functools.partial(self.reload, plugin))
+
+    def apply_config(self, plugin):
+        """Collector level settings of a plugin config: deduplication, encoding
+        and aggregation
+        """
+        plugin.dedup = self.dedup if plugin.config.get('deduplicate', plugin.deduplicate) else None
+        self.publisher.set_encoding(plugin.mqtt_topic, plugin.config.get('encoding'))
+
+        aggregate = plugin.config.get('aggregate')
+        if not aggregate:
+            plugin.aggregator = None
+            self.aggregator.configure(plugin.mqtt_topic)
+            return
+        raw_topic = aggregate.get('raw_topic')
+        if raw_topic:
+            self.publisher.set_encoding(raw_topic, plugin.config.get('encoding'))
+        self.aggregator.configure(
+                plugin.mqtt_topic, aggregate.get('window', 60), aggregate.get('counters', plugin.counters), raw_topic)
+        plugin.aggregator = self.aggregator
+
+    def reload(self, plugin, config):
+        """Push a changed config.json into the running plugin, between two
+        runs of its jobs since configure() may reset the state they use
+        """
+        self.executor.between_runs(plugin.name, functools.partial(self.reconfigure, plugin, config))
+
+    def reconfigure(self, plugin, config):
+        """Apply config to plugin and reschedule its jobs in case their
+        interval changed
+        """
+        plugin.reconfigure(config)
+        self.apply_config(plugin)
+        if plugin.active:
+            self.scheduler.replace(plugin.name, plugin.scheduler())
+        logging.info(f'plugin {plugin.name} reconfigured')
+
+    def connect(self):
+        """Open the MQTT connection shared by all plugins
+        """
+        self.mqtt.start()
+        self.publisher.start()
+        self.aggregator.start()
+        self.metrics.start()
+        store.start()
+
+    def close(self):
+        """Wait for running jobs, flush the pending batches and close
+        the shared MQTT connection
+        """
+        store.stop()
+        self.scheduler.stop()
+        self.executor.shutdown()
+        self.metrics.stop()
+        self.aggregator.stop()
+        self.publisher.stop()
+        self.dedup.close()
+        self.mqtt.stop()
+
+    def http_stats(self):
+        """Return the http client counters of each plugin, per host
+        """
+        return {plugin.name: plugin.http.stats for plugin in self.plugins}
+
+    def collect_metrics(self):
+        """Metrics collector exporting the counters kept by the executor,
+        the http clients, the dedup filter and the outbox
+        """
+        for key, counters in list(self.executor.stats.items()):
+            plugin, _, job = key.partition('.')
+            for outcome, count in counters.items():
+                yield 'counter', 'collector_jobs_total', {'plugin': plugin, 'job': job, 'outcome': outcome}, count
+
+        for plugin in self.plugins:
+            clients = [plugin.http]
+            if isinstance(plugin.ahttp, AsyncHttpClient):
+                clients.append(plugin.ahttp)
+            for client in clients:
+                for host, stats in list(client.stats.items()):
+                    labels = {'plugin': plugin.name, 'host': host}
+                    yield 'counter', 'collector_http_requests_total', labels, stats['requests']
+                    yield 'counter', 'collector_http_errors_total', labels, stats['errors']
+                    yield 'counter', 'collector_http_retries_total', labels, stats['retries']
+                    yield 'counter', 'collector_http_received_bytes_total', labels, stats['bytes_received']
+
+        for topic, stats in list(self.dedup.stats.items()):
+            for result, count in stats.items():
+                yield 'counter', 'collector_dedup_points_total', {'topic': topic, 'result': result}, count
+
+        if self.mqtt.outbox is not None:
+            yield 'gauge', 'collector_outbox_messages', {}, self.mqtt.outbox.count()
+            yield 'counter', 'collector_outbox_evicted_total', {}, self.mqtt.outbox.evicted
 
     def list(self):
         """List plugins
         """
         logging.info('list of plugins:')
         for plugin in self.plugins:
-            logging.info(f'  * {plugin.description} ({plugin.name}/{plugin.version})')
-
-    def walk(self, package):
-        """Recursively walk the supplied package to retrieve all plugins
-        """
-        imported_package = __import__(package, fromlist=['blah'])
-
-        for _, pluginname, ispkg in pkgutil.iter_modules(imported_package.__path__, imported_package.__name__ + '.'):
-            if not ispkg:
-                plugin_module = __import__(pluginname, fromlist=['blah'])
-                clsmembers = inspect.getmembers(plugin_module, inspect.isclass)
-                for (_, c) in clsmembers:
-                    # Only add classes that are a sub class of Plugin, but NOT Plugin itself
-                    if issubclass(c, Plugin) & (c is not Plugin):
-                        logging.debug(f'found plugin class: {c.__module__}.{c.__name__}')
-                        self.plugins.append(c())
-
-        # Now that we have looked at all the modules in the current package, start looking
-        # recursively for additional modules in sub packages
-        all_current_paths = []
-        if isinstance(imported_package.__path__, str):
-            all_current_paths.append(imported_package.__path__)
-        else:
-            all_current_paths.extend([x for x in imported_package.__path__])
-
-        for pkg_path in all_current_paths:
-            if pkg_path not in self.seen_paths:
-                self.seen_paths.append(pkg_path)
-
-                # Get all sub directory of the current package path directory
-                child_pkgs = [p for p in os.listdir(pkg_path) if os.path.isdir(os.path.join(pkg_path, p))]
-
-                # For each sub directory, apply the walk method recursively
-                for child_pkg in child_pkgs:
-                    self.walk(package + '.' + child_pkg)
-
-    def schedule(self):
-        schedulers = []
+            timing = self.timings[plugin.name]
+            logging.info(f'  * {plugin.description} ({plugin.name}/{plugin.version})'
+                         f' import {timing["import"]:.3f}s, init {timing["init"]:.3f}s')
 
+    def load(self, manifest):
+        """Import the plugin module and instantiate the plugin class,
+        recording the time spent in both steps
+        """
+        start = time.perf_counter()
+        plugin_module = importlib.import_module(manifest['module'])
+        imported = time.perf_counter()
+        plugin = getattr(plugin_module, manifest['class'])()
+        created = time.perf_counter()
+
+        self.timings[plugin.name] = {
+            'import': imported - start,
+            'init': created - imported,
+        }
+        logging.debug(f'loaded plugin {plugin.name}: import {imported - start:.3f}s, init {created - imported:.3f}s')
+        return plugin
+
+    def add_schedulers(self):
+        """Hand the schedulers of all active plugins to the event scheduler
+        """
         for plugin in self.plugins:
             if plugin.active:
                 sch = plugin.scheduler()
                 logging.info(f'running plugin {plugin.name}/{plugin.version}, publishing to {plugin.mqtt_topic}')
-                try:
-                    sch.run_all()
-                except Exception as ex:
-                    logging.error(str(ex))
-
-                schedulers.append(sch)
+                self.scheduler.add(plugin.name, sch)
 
+    def schedule(self):
+        """Run the jobs of all active plugins, forever or until
+        the event scheduler is stopped
+        """
+        self.add_schedulers()
         logging.info('running at scheduled time')
-        while True:
-            for s in schedulers:
-                try:
-                    s.run_pending()
-                except Exception as ex:
-                    logging.error(str(ex))
-
-            time.sleep(1)
+        self.scheduler.run()
+
+    def run_async(self):
+        """Asyncio runtime, replacing connect(), schedule() and close(): the
+        scheduler, the MQTT network I/O and the http requests of coroutine
+        jobs (through aiohttp when installed) share one event loop, plain
+        jobs still run on the thread pool
+        """
+        asyncio.run(self._run_async())
+
+    async def _run_async(self):
+        loop = asyncio.get_running_loop()
+        self.executor = AsyncExecutor(loop)
+        self.scheduler = AsyncScheduler()
+        use_aiohttp = aiohttp_available()
+        for plugin in self.plugins:
+            plugin.executor = self.executor
+            if use_aiohttp:
+                plugin.ahttp = AsyncHttpClient(timeout=plugin.http.timeout, retries=plugin.http.retries, backoff=plugin.http.backoff)
+                # the same dict, headers set later (a session token) apply to both
+                plugin.ahttp.headers = plugin.http.headers
+                plugin.ahttp.verify = plugin.http.verify
+                plugin.ahttp.name = plugin.name
+        logging.info(f'asyncio runtime, http requests of coroutine jobs {"on the loop" if use_aiohttp else "on threads"}')
+
+        self.mqtt.start_async(loop)
+        self.publisher.start()
+        self.aggregator.start()
+        self.metrics.start()
+        store.start()
+        try:
+            self.add_schedulers()
+            logging.info('running at scheduled time')
+            await self.scheduler.run()
+        finally:
+            await loop.run_in_executor(None, store.stop)
+            self.scheduler.stop()
+            await self.executor.join()
+            await loop.run_in_executor(None, self.executor.shutdown)
+            await loop.run_in_executor(None, self.metrics.stop)
+            await loop.run_in_executor(None, self.aggregator.stop)
+            self.publisher.stop()
+            self.dedup.close()
+            for plugin in self.plugins:
+                await plugin.ahttp.close()
+            await self.mqtt.stop_async()
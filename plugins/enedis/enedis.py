@@ -1,10 +1,9 @@
 import datetime
-import dateutil.parser
-import json
 import logging
+from pipeline import response_items
 import plugin
-import requests
 import schedule
+from timestamps import parse_timestamp
 
 
 class Enedis(plugin.Plugin):
@@ -15,26 +14,40 @@ class Enedis(plugin.Plugin):
         self.version = '1.0'
         self.description = 'Enedis Power Consumption Collector'
         self.mqtt_topic = '/power/enedis'
+        self.deduplicate = True
 
-        self.url_base = 'https://enedisgateway.tech/api'
+        # the load curve is served 7 days at a time, and the gateway
+        # throttles bursts of calls
+        self.backfill_chunk = datetime.timedelta(days=7)
+        self.backfill_workers = 2
+
+        self.configure()
+
+    def configure(self):
+        self.url_base = self.config.get('url', 'https://enedisgateway.tech/api')
+        self.times = self.config.get('times', ['02:18', '08:06', '14:32', '20:54'])
 
     def scheduler(self):
         scheduler = schedule.Scheduler()
-        scheduler.every().day.at('02:18').do(self.run_threaded, self.job)
-        scheduler.every().day.at('08:06').do(self.run_threaded, self.job)
-        scheduler.every().day.at('14:32').do(self.run_threaded, self.job)
-        scheduler.every().day.at('20:54').do(self.run_threaded, self.job)
+        for at in self.times:
+            scheduler.every().day.at(at).do(self.run_threaded, self.job)
         return scheduler
 
     def job(self):
         today = datetime.date.today()
-        before = today - datetime.timedelta(days=3)
+        self.fetch(today - datetime.timedelta(days=3), today)
 
+    def backfill(self, start, end):
+        self.fetch(start, end + datetime.timedelta(days=1))
+
+    def fetch(self, start, end):
+        """Emit the load curve from day start to day end excluded
+        """
         payload = {
             'type': 'consumption_load_curve',
             'usage_point_id': self.config['pdl'],
-            'start': before.strftime('%Y-%m-%d'),
-            'end': today.strftime('%Y-%m-%d'),
+            'start': start.strftime('%Y-%m-%d'),
+            'end': end.strftime('%Y-%m-%d'),
         }
 
         headers = {
@@ -42,25 +55,19 @@ class Enedis(plugin.Plugin):
             'Content-Type': "application/json",
         }
 
-        logging.info('retrieving data from Enedis')
-        r = requests.post(self.url_base, json=payload, headers=headers)
-        logging.debug(
-            'result: status=' +
-            str(r.status_code) +
-            ', json=' +
-            json.dumps(r.json()))
-        data = []
-        for measure in r.json()['meter_reading']['interval_reading']:
-            dt = dateutil.parser.parse(measure['date'])
-            # dt = datetime.datetime.strptime(
-            #     measure['date'],
-            #     '%Y-%m-%d %H:%M:%S')
-            data.append({
-                'timestamp': int(datetime.datetime.timestamp(dt)),
+        logging.info(f'retrieving data from Enedis, {start} to {end}')
+        r = self.http.post(self.url_base, json=payload, headers=headers, stream=True)
+        logging.debug(f'result: status={r.status_code}')
+        r.raise_for_status()
+        count = self.emit_all(self.transform(response_items(r, 'meter_reading.interval_reading.item')))
+        logging.debug(f'{count} points emitted')
+
+    def transform(self, measures):
+        for measure in measures:
+            yield {
+                'timestamp': parse_timestamp(measure['date']),
                 'measurement': 'enedis',
                 'fields': {
                     'power': measure['value']
                 },
-            })
-        mqtt_client = self.get_mqtt_client(self.name)
-        mqtt_client.publish(self.mqtt_topic, json.dumps(data))
+            }
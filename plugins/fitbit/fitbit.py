@@ -1,161 +1,118 @@
+from columns import ColumnBuffer
 import datetime
-import dateutil.parser
 import fitbit
+from concurrent.futures import ThreadPoolExecutor
+import itertools
 import json
 import logging
+from pipeline import response_items
 import plugin
+from ratelimit import TokenBucket
 import schedule
+import threading
 import time
+from timestamps import parse_timestamp
 import os
-import sys
+
+
+# Transforms turn one api datapoint into records grouping all the fields
+# sharing a timestamp: {'dateTime', 'meas', 'fields'}
+#
+# The daily series stay dict based on purpose, only the intraday series go
+# through a ColumnBuffer: they are a few points a day, with bool and level
+# fields and a field set varying from one datapoint to the next (heart rate
+# zones, sleep levels) that a buffer of doubles cannot hold, and they are
+# republished over overlapping windows so they must go through the dedup
+# filter, which emit_buffer() skips.
 
 
 def transform_body_log_fat_datapoint(datapoint):
     ret_dps = [{
-        'dateTime': datetime.fromtimestamp(int(datapoint['logId']) / 1000),
+        'dateTime': datetime.datetime.fromtimestamp(int(datapoint['logId']) / 1000),
         'meas': 'body_log',
-        'series': 'fat_fat',
-        'value': datapoint.get('fat', 0.0)
+        'fields': {'fat_fat': datapoint.get('fat', 0.0)},
     }]
     logging.debug('returning body_log_fat datapoints: %s', ret_dps)
     return ret_dps
 
 
 def transform_body_log_weight_datapoint(datapoint):
-    ret_dps = [
-        {
-            'dateTime': datetime.fromtimestamp(int(datapoint['logId'])/1000),
-            'meas': 'body_log',
-            'series': 'weight_bmi',
-            'value': datapoint.get('bmi', 0.0)
-        },
-        {
-            'dateTime': datetime.fromtimestamp(int(datapoint['logId'])/1000),
-            'meas': 'body_log',
-            'series': 'weight_fat',
-            'value': datapoint.get('fat', 0.0)
+    ret_dps = [{
+        'dateTime': datetime.datetime.fromtimestamp(int(datapoint['logId']) / 1000),
+        'meas': 'body_log',
+        'fields': {
+            'weight_bmi': datapoint.get('bmi', 0.0),
+            'weight_fat': datapoint.get('fat', 0.0),
+            'weight_weight': datapoint.get('weight', 0.0),
         },
-        {
-            'dateTime': datetime.fromtimestamp(int(datapoint['logId'])/1000),
-            'meas': 'body_log',
-            'series': 'weight_weight',
-            'value': datapoint.get('weight', 0.0)
-        }
-    ]
+    }]
     logging.debug('returning body_log_weight datapoints: %s', ret_dps)
     return ret_dps
 
 
+HEART_RATE_ZONE_VALUES = ('caloriesOut', 'max', 'min', 'minutes')
+
+
 def transform_activities_heart_datapoint(datapoint):
     logging.debug('transform_activities_heart_datapoint: %s', datapoint)
-    d_t = datapoint['dateTime']
     dp_value = datapoint['value']
-    ret_dps = [
-        {
-            'dateTime': d_t,
-            'meas': 'activities',
-            'series': 'restingHeartRate',
-            'value': dp_value.get('restingHeartRate', 0.0)
-        }
-    ]
-    if dp_value.get('heartRateZones'):
-        for zone in dp_value['heartRateZones']:
-            for one_val in ['caloriesOut', 'max', 'min', 'minutes']:
-                series_name = '_'.join(['hrz', zone['name'].replace(' ', '_').lower(), one_val])
-                ret_dps.append({
-                    'dateTime': d_t,
-                    'meas': 'activities',
-                    'series': series_name,
-                    'value': zone.get(one_val, 0.0)
-                })
+    fields = {'restingHeartRate': dp_value.get('restingHeartRate', 0.0)}
+    for zone in dp_value.get('heartRateZones') or ():
+        prefix = 'hrz_' + zone['name'].replace(' ', '_').lower() + '_'
+        for one_val in HEART_RATE_ZONE_VALUES:
+            fields[prefix + one_val] = zone.get(one_val, 0.0)
+    ret_dps = [{'dateTime': datapoint['dateTime'], 'meas': 'activities', 'fields': fields}]
     logging.debug('returning activities_heart datapoints: %s', ret_dps)
     return ret_dps
 
 
+SLEEP_LEVEL_VALUES = ('count', 'minutes', 'thirtyDayAvgMinutes')
+
+
 def transform_sleep_datapoint(datapoint):
     d_t = datapoint['startTime']
-    ret_dps = [
-        {
-            'dateTime': d_t,
-            'meas': 'sleep',
-            'series': 'duration',
-            'value': datapoint.get('duration', 0) / 1000
-        },
-        {
-            'dateTime': d_t,
-            'meas': 'sleep',
-            'series': 'efficiency',
-            'value': datapoint.get('efficiency')
-        },
-        {
-            'dateTime': d_t,
-            'meas': 'sleep',
-            'series': 'isMainSleep',
-            'value': datapoint.get('isMainSleep', False)
-        },
-        {
-            'dateTime': d_t,
-            'meas': 'sleep',
-            'series': 'timeInBed',
-            'value': datapoint.get('timeInBed')
-        },
-        {
-            'dateTime': d_t,
-            'meas': 'sleep',
-            'series': 'minutesAfterWakeup',
-            'value': datapoint.get('minutesAfterWakeup')
-        },
-        {
-            'dateTime': d_t,
-            'meas': 'sleep',
-            'series': 'minutesAsleep',
-            'value': datapoint.get('minutesAsleep')
-        },
-        {
-            'dateTime': d_t,
-            'meas': 'sleep',
-            'series': 'minutesAwake',
-            'value': datapoint.get('minutesAwake')
+    ret_dps = [{
+        'dateTime': d_t,
+        'meas': 'sleep',
+        'fields': {
+            'duration': datapoint.get('duration', 0) / 1000,
+            'efficiency': datapoint.get('efficiency'),
+            'isMainSleep': datapoint.get('isMainSleep', False),
+            'timeInBed': datapoint.get('timeInBed'),
+            'minutesAfterWakeup': datapoint.get('minutesAfterWakeup'),
+            'minutesAsleep': datapoint.get('minutesAsleep'),
+            'minutesAwake': datapoint.get('minutesAwake'),
+            'minutesToFallAsleep': datapoint.get('minutesToFallAsleep'),
         },
-        {
-            'dateTime': d_t,
-            'meas': 'sleep',
-            'series': 'minutesToFallAsleep',
-            'value': datapoint.get('minutesToFallAsleep')
-        }
-    ]
-    if datapoint.get('levels'):
-        if datapoint.get('summary'):
-            for one_level, dict_level in datapoint['levels']['summary'].items():
-                for one_val in ['count', 'minutes', 'thirtyDayAvgMinutes']:
-                    ret_dps.append({
-                        'dateTime': d_t,
-                        'meas': 'sleep_levels',
-                        'series': one_level.lower() + '_' + one_val,
-                        'value': dict_level.get(one_val)
-                    })
-        if datapoint.get('data'):
-            for data_entry in datapoint['levels']['data']:
-                for one_val in ['level', 'seconds']:
-                    ret_dps.append({
-                        'dateTime': data_entry['datetime'],
-                        'meas': 'sleep_data',
-                        'series': 'level_' + data_entry['level'],
-                        'value': data_entry['seconds']
-                    })
-        if datapoint.get('shortData'):
-            for data_entry in datapoint['levels']['shortData']:
-                for one_val in ['level', 'seconds']:
-                    ret_dps.append({
-                        'dateTime': data_entry['datetime'],
-                        'meas': 'sleep_shortData',
-                        'series': 'level_' + data_entry['level'],
-                        'value': data_entry['seconds']
-                    })
+    }]
+    levels = datapoint.get('levels')
+    if levels:
+        if levels.get('summary'):
+            fields = {}
+            for one_level, dict_level in levels['summary'].items():
+                prefix = one_level.lower() + '_'
+                for one_val in SLEEP_LEVEL_VALUES:
+                    fields[prefix + one_val] = dict_level.get(one_val)
+            ret_dps.append({'dateTime': d_t, 'meas': 'sleep_levels', 'fields': fields})
+        for key, meas in (('data', 'sleep_data'), ('shortData', 'sleep_shortData')):
+            for data_entry in levels.get(key) or ():
+                ret_dps.append({
+                    'dateTime': data_entry['dateTime'],
+                    'meas': meas,
+                    'fields': {'level_' + data_entry['level']: data_entry['seconds']},
+                })
     logging.debug('returning sleep datapoints: %s', ret_dps)
     return ret_dps
 
 
+def transform_intraday_datapoint(datapoint, midnight):
+    """Intraday datapoint {'time': 'HH:MM:SS', 'value'} as a (timestamp, value)
+    row of a ColumnBuffer, midnight being the timestamp of the start of its day
+    """
+    h, m, s = datapoint['time'].split(':')
+    return midnight + int(h) * 3600 + int(m) * 60 + int(s), float(datapoint['value'])
+
+
 class Fitbit(plugin.Plugin):
     def __init__(self):
         super().__init__()
@@ -164,13 +121,39 @@ class Fitbit(plugin.Plugin):
         self.version = '1.0'
         self.description = 'Fitbit Collector'
         self.mqtt_topic = '/health/fitbit'
+        self.deduplicate = True
 
         self.api_requests = 0
-        self.api_pause_until = 0
+        self.api_budget = TokenBucket(self.API_RATE_LIMIT, 3600)
+
+        # resources are fetched concurrently, token refreshes and cursor
+        # updates are serialized
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+
+        self.cursors = self.cursor_load()
+
+        # body series have max 31 days at a time, a backfill shares one
+        # client between its chunks so that token refreshes are serialized
+        self.backfill_chunk = datetime.timedelta(days=31)
+        self.backfill_workers = 4
+        self.backfill_client = None
+
+        self.configure()
+
+    def configure(self):
+        self.interval = self.config.get('interval', 15)
+        self.intraday = {}
+        for resource, details in self.config.get('intraday', {}).items():
+            supported = [d for d in details if d in self.INTRADAY_DETAILS.get(resource, ())]
+            if len(supported) != len(details):
+                logging.warning(f'unsupported Fitbit intraday series {resource} {details}, expected one of {self.INTRADAY_DETAILS}')
+            if supported:
+                self.intraday[resource] = supported
 
     def scheduler(self):
         scheduler = schedule.Scheduler()
-        scheduler.every(15).minutes.do(self.run_threaded, self.job)
+        scheduler.every(self.interval).minutes.do(self.run_threaded, self.job)
         return scheduler
 
     SERIES = {
@@ -206,6 +189,7 @@ class Fitbit(plugin.Plugin):
         ],
         'sleep': {
             'sleep': {
+                'api_version': '1.2',
                 'key_series': 'efficiency',
                 # supercomplex type: https://dev.fitbit.com/build/reference/web-api/sleep/
                 'transform': transform_sleep_datapoint
@@ -213,22 +197,155 @@ class Fitbit(plugin.Plugin):
         }
     }
 
+    # Intraday series and their resolutions, each day is one api call. Fitbit
+    # only grants them to personal apps, so they are enabled in config.json:
+    # "intraday": {"activities/heart": ["1sec", "1min"], "activities/steps": ["1min"]}
+    INTRADAY_DETAILS = {
+        'activities/heart': ('1sec', '1min'),
+        'activities/steps': ('1min',),
+    }
+
+    # Fetch priority per measurement or resource, lower goes first
+    PRIORITIES = {
+        'activities/heart': 0,
+        'activities': 0,
+        'activities_tracker': 1,
+        'sleep': 1,
+        'intraday': 1,
+    }
+
+    # Calls per hour allowed by Fitbit, and tokens left aside for the higher
+    # priorities: a fetch of priority p only happens while more than
+    # PRIORITY_RESERVES[p] calls remain. Catching up more than a couple of
+    # days is a backfill, which only gets the leftover capacity
+    API_RATE_LIMIT = 150
+    PRIORITY_RESERVES = [0, 15, 40]
+    BACKFILL_PRIORITY = 2
+
     # Body series have max 31 days at a time, be a bit more conservative
     REQUEST_INTERVAL = datetime.timedelta(days=7)
 
+    # Days already synced are fetched again for that long, trackers may sync late
+    RECHECK_INTERVAL = datetime.timedelta(days=1)
+
+    def cursor_load(self):
+        """Per resource sync cursors: last fully synced day and last datapoint timestamp
+        """
+        file = self.plugin_file('cursor.json')
+        if not os.path.exists(file):
+            return {}
+        with open(file) as f:
+            return json.load(f)
+
+    def cursor_save(self):
+        file = self.plugin_file('cursor.json')
+        with open(file + '.tmp', 'w') as f:
+            json.dump(self.cursors, f)
+        os.replace(file + '.tmp', file)
+
+    def fetch_interval(self, resource, today):
+        """First and last day to fetch for resource: from the day after the
+        last fully synced one (minus the recheck interval) up to today
+        """
+        cursor = self.cursors.get(resource)
+        if cursor is None:
+            return today - self.REQUEST_INTERVAL, today
+        synced = datetime.date.fromisoformat(cursor['synced'])
+        start = synced + datetime.timedelta(days=1) - self.RECHECK_INTERVAL
+        return max(start, today - self.REQUEST_INTERVAL), today
+
+    def cursor_update(self, resource, today, last):
+        # the points up to last must be spooled in the outbox before the
+        # cursor moves past them, they would not be fetched again otherwise
+        self.publisher.flush(self.mqtt_topic)
+        with self.lock:
+            cursor = self.cursors.setdefault(resource, {'synced': None, 'last': 0})
+            # today is still in progress, so only yesterday is fully synced
+            cursor['synced'] = (today - datetime.timedelta(days=1)).isoformat()
+            cursor['last'] = max(cursor['last'], last)
+            self.cursor_save()
+
+    def serialize_token_refresh(self, fitc):
+        """Wrap the OAuth client token refresh so that concurrent fetches hitting
+        an expired token refresh it only once: Fitbit refresh tokens are single
+        use, and each refresh rewrites config.json
+        """
+        refresh_token = fitc.client.refresh_token
+
+        def serialized_refresh_token():
+            expired = fitc.client.session.token.get('access_token')
+            with self.refresh_lock:
+                if fitc.client.session.token.get('access_token') != expired:
+                    logging.debug('Fitbit token already refreshed by another fetch')
+                    return fitc.client.session.token
+                return refresh_token()
+
+        fitc.client.refresh_token = serialized_refresh_token
+
+    def time_series(self, fitc, resource, base_date, end_date, api_version):
+        """Same as fitc.time_series but with an explicit api version, as
+        the client is shared by the fetch threads, and a streamed body: the
+        datapoints of the series are parsed as they are read
+        """
+        url = '{0}/{1}/user/-/{resource}/date/{base_date}/{end_date}.json'.format(
+            fitc.API_ENDPOINT,
+            api_version,
+            resource=resource,
+            base_date=base_date.strftime('%Y-%m-%d'),
+            end_date=end_date.strftime('%Y-%m-%d'))
+        r = fitc.client.make_request(url, headers={'Accept-Language': fitc.system}, stream=True)
+        return response_items(r, resource.replace('/', '-') + '.item')
+
+    def intraday_series(self, fitc, resource, day, detail):
+        """Streamed intraday datapoints of resource on day, at detail resolution
+        """
+        url = '{0}/1/user/-/{resource}/date/{day}/1d/{detail}.json'.format(
+            fitc.API_ENDPOINT,
+            resource=resource,
+            day=day.strftime('%Y-%m-%d'),
+            detail=detail)
+        r = fitc.client.make_request(url, headers={'Accept-Language': fitc.system}, stream=True)
+        return response_items(r, resource.replace('/', '-') + '-intraday.dataset.item')
+
     def write_updated_credentials(self, info):
         self.config['access_token'] = info['access_token']
         self.config['refresh_token'] = info['refresh_token']
         self.config_save()
 
-    def fitbit_fetch_datapoints(self, fitc, meas, series, resource, intervals_to_fetch):
-        datapoints = []
+    def on_api_response(self, r, *args, **kwargs):
+        """Response hook keeping the budget in line with the rate limit headers
+        """
+        remaining = r.headers.get('Fitbit-Rate-Limit-Remaining')
+        reset = r.headers.get('Fitbit-Rate-Limit-Reset')
+        if remaining is not None and reset is not None:
+            self.api_budget.update(int(remaining), int(reset))
+
+    def fitbit_fetch_datapoints(self, fitc, meas, series, resource, intervals_to_fetch, reserve=0, api_version='1', wait=False, detail=None):
+        """Fetch the datapoints of resource, as an iterator over the streamed
+        answers, or return None when the api budget does not allow it (or
+        the rate limit was hit). With wait, the call waits for the budget
+        instead. With detail, the intraday datapoints of the first day of
+        each interval are fetched at that resolution
+        """
+        answers = []
         for one_tuple in intervals_to_fetch:
             results = None
             while True:
+                if not self.api_budget.try_acquire(reserve=reserve):
+                    if not wait:
+                        logging.info(f'Fitbit api budget exhausted, deferring {resource}')
+                        return None
+                    delay = max(1.0, self.api_budget.wait_time(reserve=reserve))
+                    logging.info(f'Fitbit api budget exhausted, waiting {delay:.0f} seconds for {resource}')
+                    time.sleep(delay)
+                    continue
                 try:
-                    self.api_requests += 1
-                    results = fitc.time_series(resource, base_date=one_tuple[0], end_date=one_tuple[1])
+                    with self.lock:
+                        self.api_requests += 1
+                    if detail is None:
+                        results = self.time_series(fitc, resource, one_tuple[0], one_tuple[1], api_version)
+                    else:
+                        results = self.intraday_series(fitc, resource, one_tuple[0], detail)
                     break
                 except fitbit.exceptions.Timeout:
                     logging.warning('Request timed out, retrying in 15 seconds...')
@@ -236,52 +353,69 @@ class Fitbit(plugin.Plugin):
                 except fitbit.exceptions.HTTPServerError as ex:
                     logging.warning('Server returned exception (5xx), retrying in 15 seconds (%s)', ex)
                     time.sleep(15)
-                except fitbit.exceptions.HTTPTooManyRequests:
-                    # 150 API calls done, and python-fitbit doesn't provide the retry-after header, so stop trying
-                    # and allow the limit to reset, even if it costs us one hour
-                    logging.info('API limit reached, pause for 3610 seconds!')
-                    self.api_pause_until = int(time.time()) + 3610
+                except fitbit.exceptions.HTTPTooManyRequests as ex:
+                    logging.info(f'API limit reached, pause for {ex.retry_after_secs} seconds!')
+                    self.api_budget.update(0, ex.retry_after_secs)
+                    if not wait:
+                        return None
                 except Exception as ex:
                     logging.exception('Got some unexpected exception (%s)', ex)
                     raise
 
-            if not results:
-                logging.error('Error trying to fetch results, bailing out')
-                sys.exit(1)
-
-            logging.debug('full_request: %s', results)
-            for one_d in list(results.values())[0]:
-                logging.debug('Creating datapoint for %s, %s, %s', meas, series, one_d)
-                datapoints.append(one_d)
-        return datapoints
-
-    def create_api_datapoint_meas_series(self, measurement, series, value, in_dt):
-        if not value:
-            value = 0.0
-        try:
-            value = float(value)
-        except Exception:
-            pass
+            answers.append(results)
+        return itertools.chain.from_iterable(answers)
+
+    def priority(self, meas, resource, start, end):
+        if end - start > self.RECHECK_INTERVAL + datetime.timedelta(days=1):
+            return self.BACKFILL_PRIORITY
+        return self.PRIORITIES.get(resource, self.PRIORITIES.get(meas, self.BACKFILL_PRIORITY))
+
+    def create_api_datapoint(self, measurement, fields, in_dt):
+        values = {}
+        for series, value in fields.items():
+            if not value:
+                value = 0.0
+            try:
+                value = float(value)
+            except Exception:
+                pass
+            values[series] = value
 
         return {
             "measurement": measurement,
-            "timestamp": int(datetime.datetime.timestamp(dateutil.parser.parse(in_dt))),
-            "fields": {series: value}
+            "timestamp": parse_timestamp(in_dt),
+            "fields": values
         }
 
     def job(self):
-        if int(time.time()) < self.api_pause_until:
-            logging.info('Fitbit api pause until ' + str(datetime.fromtimestamp(self.api_pause_until)))
+        available = self.api_budget.available()
+        if available < 1:
+            logging.info(f'Fitbit api budget exhausted for {self.api_budget.wait_time():.0f} seconds')
             return
 
-        self.api_pause_until = 0
-        logging.info('retrieving data from Fitbit')
+        logging.info(f'retrieving data from Fitbit, {available:.0f} api calls available')
 
         today = datetime.date.today()
-        yesterday = today - self.REQUEST_INTERVAL
-
-        mqtt_client = self.get_mqtt_client(self.name)
-
+        fitc = self.client()
+
+        # fetch by priority, what the budget does not allow waits for a later run
+        plan = []
+        for meas, series_list, series, resource in self.resources():
+            start, end = self.fetch_interval(resource, today)
+            plan.append((self.priority(meas, resource, start, end), meas, series_list, series, resource, start, end))
+        plan.sort(key=lambda p: p[0])
+
+        with ThreadPoolExecutor(max_workers=self.config.get('fetch_workers', 4), thread_name_prefix='fitbit') as pool:
+            futures = [pool.submit(self.fetch_resource, fitc, today, *p) for p in plan]
+            # intraday series come after the daily ones, a day at a time
+            for resource, details in self.intraday.items():
+                for detail in details:
+                    futures.append(pool.submit(self.fetch_intraday, fitc, today, resource, detail))
+        for future in futures:
+            if future.exception() is not None:
+                logging.error(f'Fitbit fetch failed: {future.exception()}')
+
+    def client(self):
         fitc = fitbit.Fitbit(
             self.config['client_id'],
             self.config['client_secret'],
@@ -289,10 +423,18 @@ class Fitbit(plugin.Plugin):
             refresh_token=self.config['refresh_token'],
             refresh_cb=self.write_updated_credentials,
             system=fitbit.Fitbit.METRIC)
+        fitc.API_ENDPOINT = self.config.get('api_endpoint', fitc.API_ENDPOINT)
 
         # avoid OAuth/https exception
         os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'
 
+        fitc.client.session.hooks['response'].append(self.on_api_response)
+        self.serialize_token_refresh(fitc)
+        return fitc
+
+    def resources(self):
+        """(meas, series_list, series, resource) of each series to fetch
+        """
         for meas, series_list in self.SERIES.items():
             for series in series_list:
                 if meas != series:
@@ -301,40 +443,112 @@ class Fitbit(plugin.Plugin):
                     resource = meas
 
                 resource = resource.replace('_', '/', 1)
+                yield meas, series_list, series, resource
+
+    def api_version(self, series_list, series):
+        if isinstance(series_list, dict) and series_list.get(series):
+            return series_list[series].get('api_version', '1')
+        return '1'
+
+    def backfill(self, start, end):
+        with self.lock:
+            if self.backfill_client is None:
+                self.backfill_client = self.client()
+        for meas, series_list, series, resource in self.resources():
+            logging.debug(f'backfilling {resource} from {start} to {end}')
+            datapoints = self.fitbit_fetch_datapoints(
+                self.backfill_client, meas, series, resource, [[start, end]],
+                reserve=self.PRIORITY_RESERVES[self.BACKFILL_PRIORITY],
+                api_version=self.api_version(series_list, series), wait=True)
+            if datapoints is None:
+                raise RuntimeError(f'fetching {resource} failed')
+            self.emit_all(self.convert_datapoints(meas, series_list, series, datapoints))
+        for resource, details in self.intraday.items():
+            for detail in details:
+                for _, buffer in self.intraday_days(self.backfill_client, resource, detail, start, end, wait=True):
+                    self.emit_buffer(buffer)
+
+    def fetch_resource(self, fitc, today, priority, meas, series_list, series, resource, start, end):
+        logging.debug(f'fetching {resource} from {start} to {end}, priority {priority}')
+
+        # key_series = series
+        # if isinstance(series_list, dict) and series_list.get(series):
+        #     # Datapoints are retrieved with all keys in the same dict, so makes no sense to retrieve individual
+        #     # series names. Use one series as the key series.
+        #     key_series = series_list[series]['key_series']
+
+        datapoints = self.fitbit_fetch_datapoints(
+            fitc, meas, series, resource, [[start, end]],
+            reserve=self.PRIORITY_RESERVES[priority], api_version=self.api_version(series_list, series))
+        if datapoints is None:
+            return
 
-                logging.debug(f'resource={resource}')
-
-                # key_series = series
-                # if isinstance(series_list, dict) and series_list.get(series):
-                #     # Datapoints are retrieved with all keys in the same dict, so makes no sense to retrieve individual
-                #     # series names. Use one series as the key series.
-                #     key_series = series_list[series]['key_series']
-
-                if meas == 'sleep':
-                    fitc.API_VERSION = '1.2'
-                datapoints = self.fitbit_fetch_datapoints(fitc, meas, series, resource, [[yesterday, today]])
-                if meas == 'sleep':
-                    fitc.API_VERSION = '1'
-
-                converted_dps = []
-                for one_d in datapoints:
-                    if not one_d:
-                        continue
-                    if isinstance(series_list, dict) and series_list.get(series):
-                        new_dps = series_list[series]['transform'](one_d)
-                        for one_dd in new_dps:
-                            converted_dps.append(
-                                self.create_api_datapoint_meas_series(
-                                    one_dd['meas'], one_dd['series'], one_dd['value'], one_dd['dateTime']))
-                    else:
-                        converted_dps.append(
-                            self.create_api_datapoint_meas_series(
-                                meas, series, one_d.get('value'), one_d.get('dateTime')))
-
-                # precision = 'h'
-                # if meas == 'sleep':
-                #     precision = 's'
-
-                for data in converted_dps:
-                    logging.debug(json.dumps(data))
-                    mqtt_client.publish(self.mqtt_topic, json.dumps([data]))
+        # precision = 'h'
+        # if meas == 'sleep':
+        #     precision = 's'
+
+        last = 0
+        for data in self.convert_datapoints(meas, series_list, series, datapoints):
+            self.emit(data)
+            last = max(last, data['timestamp'])
+
+        self.cursor_update(resource, today, last)
+
+    def convert_datapoints(self, meas, series_list, series, datapoints):
+        """Generator turning the datapoints of the api into points
+        """
+        for one_d in datapoints:
+            if not one_d:
+                continue
+            logging.debug('Creating datapoint for %s, %s, %s', meas, series, one_d)
+            if isinstance(series_list, dict) and series_list.get(series):
+                for one_dd in series_list[series]['transform'](one_d):
+                    yield self.create_api_datapoint(one_dd['meas'], one_dd['fields'], one_dd['dateTime'])
+            else:
+                yield self.create_api_datapoint(meas, {series: one_d.get('value')}, one_d.get('dateTime'))
+
+    def fetch_intraday(self, fitc, today, resource, detail):
+        key = f'{resource}/{detail}'
+        start, end = self.fetch_interval(key, today)
+        last = self.cursors.get(key, {}).get('last', 0)
+        logging.debug(f'fetching {key} intraday from {start} to {end}')
+
+        for day, buffer in self.intraday_days(fitc, resource, detail, start, end, after=last):
+            self.emit_buffer(buffer)
+            if buffer:
+                last = max(last, buffer.timestamps[-1])
+            # mark the day synced, or yesterday while today is in progress
+            self.cursor_update(key, min(day + datetime.timedelta(days=1), today), last)
+
+    def intraday_days(self, fitc, resource, detail, start, end, after=0, wait=False):
+        """Generator of (day, ColumnBuffer) with the intraday rows of each day
+        from start to end later than after, stopping when the api budget is
+        exhausted. The buffer is reused from one day to the next
+        """
+        buffer = ColumnBuffer(f'intraday_{detail}', [resource.rsplit('/', 1)[1]])
+        priority = self.BACKFILL_PRIORITY if wait else self.PRIORITIES['intraday']
+        day = start
+        while day <= end:
+            datapoints = self.fitbit_fetch_datapoints(
+                fitc, 'intraday', detail, resource, [[day, day]], reserve=self.PRIORITY_RESERVES[priority], wait=wait, detail=detail)
+            if datapoints is None:
+                return
+            buffer.clear()
+            for row in self.convert_intraday(day, datapoints):
+                if row[0] > after:
+                    buffer.append(*row)
+            yield day, buffer
+            day += datetime.timedelta(days=1)
+
+    def convert_intraday(self, day, datapoints):
+        """Generator of the (timestamp, value) rows of the intraday datapoints of day
+        """
+        midnight = parse_timestamp(day)
+        if parse_timestamp(day + datetime.timedelta(days=1)) - midnight == 86400:
+            for one_d in datapoints:
+                yield transform_intraday_datapoint(one_d, midnight)
+            return
+        # daylight saving time change, the local times are converted one by one
+        for one_d in datapoints:
+            at = datetime.datetime.combine(day, datetime.time.fromisoformat(one_d['time']))
+            yield int(at.timestamp()), float(one_d['value'])
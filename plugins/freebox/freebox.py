@@ -3,7 +3,6 @@ import hashlib
 import json
 import logging
 import plugin
-import requests
 import schedule
 import socket
 import tempfile
@@ -16,57 +15,86 @@ class FreeboxException(Exception):
 
 class Freebox(plugin.Plugin):
     def __init__(self):
-        super().__init__()
+        # keep-alive connections pinned to the Freebox certificate, failing
+        # fast enough for the 5 seconds interval
+        super().__init__(http_options={'timeout': (2, 4), 'retries': 1})
         self.active = True
         self.name = 'freebox'
         self.version = '1.0'
         self.description = 'Freebox Network Statistics Collector'
         self.mqtt_topic = '/net/freebox'
+        self.counters = ('bytes_up', 'bytes_down')
 
-        self.url_base = ''
         self.certificate = tempfile.NamedTemporaryFile(suffix='.pem')
+        self.http.verify = self.certificate.name
+        self.configure()
+
+    # numeric gauges and counters of the connection stats, the only fields
+    # worth aggregating (the others are state, addresses and port ranges)
+    STATS = ('rate_down', 'rate_up', 'bandwidth_down', 'bandwidth_up', 'bytes_down', 'bytes_up')
+
+    def configure(self):
+        # api_version is served over plain http, the api itself over https
+        self.discover_url = self.config.get('discover_url', 'http://mafreebox.freebox.fr/api_version')
+        self.url_root = self.config.get('url', 'https://mafreebox.freebox.fr')
+        self.interval = self.config.get('interval', 5)
         with open(self.certificate.name, 'w') as f:
             f.write(self.config['certificate'])
 
+        # the api location and the session are looked up again on next run
+        self.url_base = ''
+        self.session_token = None
+
     def __del__(self):
         logging.debug(f'deleting temporary file {self.certificate.name}')
+        self.http.close()
         self.certificate.close()
 
     def scheduler(self):
         scheduler = schedule.Scheduler()
-        scheduler.every(5).seconds.do(self.run_threaded, self.job)
+        scheduler.every(self.interval).seconds.do(self.run_threaded, self.job)
         return scheduler
 
+    def discover(self):
+        r = self.http.get(self.discover_url)
+        if r.status_code != 200:
+            raise FreeboxException('unable to get Freebox information')
+
+        info = r.json()
+        base = info['api_base_url']
+        version = info['api_version'].split('.')[0]
+        self.url_base = f'{self.url_root}{base}v{version}/'
+        logging.debug(f'Freebox api at {self.url_base}')
+
     def get_session(self, challenge):
         logging.debug(
             'starting new session from challenge: ' +
             ('None' if challenge is None else challenge))
         if 'token' not in self.config:
-            r = requests.post(
+            r = self.http.post(
                 self.url_base + 'login/authorize/',
                 json={
                     'app_id': f'{self.name}-to-mqtt',
                     'app_name': f'{self.name}-to-mqtt',
                     'app_version': self.version,
                     'device_name': socket.gethostname()
-                },
-                verify=self.certificate.name)
-            if r.status_code != 200 or r.json()['success'] is not True:
+                })
+            result = r.json()
+            if r.status_code != 200 or result['success'] is not True:
                 logging.error('unable to get authorization')
                 return None
 
-            app_token = r.json()['result']['app_token']
-            track_id = r.json()['result']['track_id']
+            app_token = result['result']['app_token']
+            track_id = result['result']['track_id']
 
             while True:
-                r = requests.get(
-                    self.url_base + 'login/authorize/' + str(track_id),
-                    verify=self.certificate.name)
+                r = self.http.get(self.url_base + 'login/authorize/' + str(track_id))
                 if r.status_code != 200:
                     logging.error('unable to track authorization')
                     return None
 
-                status = r.json()['result']['status']
+                result = r.json()['result']
+                status = result['status']
                 if status == 'pending':
                     pass
                 elif status == 'timeout':
@@ -76,7 +104,7 @@ class Freebox(plugin.Plugin):
                     logging.error('you denied authorization request')
                     return None
                 elif status == 'granted':
-                    challenge = r.json()['result']['challenge']
+                    challenge = result['challenge']
                     break
 
                 time.sleep(0.5)
@@ -84,7 +112,7 @@ class Freebox(plugin.Plugin):
             self.config['token'] = app_token
             self.config_save()
         else:
-            r = requests.get(self.url_base + 'login/', verify=self.certificate.name)
+            r = self.http.get(self.url_base + 'login/')
             if r.status_code != 200:
                 logging.error('unable to login')
                 return None
@@ -93,39 +121,73 @@ class Freebox(plugin.Plugin):
 
         logging.debug('new challenge: ' + challenge)
         password = hmac.new(bytes(self.config['token'], 'latin-1'), challenge.encode('latin-1'), hashlib.sha1).hexdigest()
-        r = requests.post(
+        r = self.http.post(
             self.url_base + 'login/session/',
             json={
                 'app_id': f'{self.name}-to-mqtt',
                 'password': password
-            },
-            verify=self.certificate.name)
+            })
         if r.status_code != 200:
             logging.error('unable to start new session')
             return None
 
         return r.json()['result']['session_token']
 
-    def job(self):
-        url = 'http://mafreebox.freebox.fr/api_version'
-        r = requests.get(url)
-        if r.status_code != 200:
-            raise FreeboxException('unable to get Freebox information')
+    @staticmethod
+    def answer(r):
+        """JSON body of an api answer, None when it is not one (a restarting
+        Freebox or a proxy may answer with an html or empty page)
+        """
+        if 'json' not in r.headers.get('Content-Type', ''):
+            return None
+        try:
+            return r.json()
+        except ValueError:
+            return None
 
-        base = r.json()['api_base_url']
-        version = r.json()['api_version'].split('.')[0]
-        self.url_base = f'https://mafreebox.freebox.fr{base}v{version}/'
+    def login(self):
+        self.session_token = self.get_session(None)
+        if self.session_token is None:
+            raise FreeboxException('unable to open a session')
+        self.http.headers['X-Fbx-App-Auth'] = self.session_token
 
-        token = self.get_session(None)
+    def job(self):
+        try:
+            self.collect()
+        except (FreeboxException, ValueError) as ex:
+            # a non 200 or non JSON answer: rediscover the api and open a new
+            # session on next run, in case the Freebox restarted or was updated
+            self.url_base = ''
+            self.session_token = None
+            if isinstance(ex, FreeboxException):
+                raise
+            raise FreeboxException(f'unexpected answer from the Freebox: {ex}') from ex
+
+    def collect(self):
+        # the api location and the session are only looked up again when needed
+        if not self.url_base:
+            self.discover()
+        if self.session_token is None:
+            self.login()
 
         logging.info('retrieving data from Freebox')
-        r = requests.get(self.url_base + 'connection/', headers={'X-Fbx-App-Auth': token}, verify=self.certificate.name)
-        logging.debug('result: status=' + str(r.status_code) + ', json=' + json.dumps(r.json()))
-        if r.status_code == 200 and r.json()['success'] is True:
-            data = r.json()['result']
+        r = self.http.get(self.url_base + 'connection/')
+        result = self.answer(r)
+        if r.status_code == 403 and result is not None and result.get('error_code') in ('auth_required', 'invalid_session'):
+            logging.debug('Freebox session expired, logging in again')
+            self.login()
+            r = self.http.get(self.url_base + 'connection/')
+            result = self.answer(r)
+
+        logging.debug('result: status=%s, json=%s', r.status_code, result)
+        if r.status_code != 200 or result is None or result.get('success') is not True:
+            raise FreeboxException(f'failed to get connection information (status {r.status_code})')
+
+        data = result['result']
+        if self.aggregator is None:
+            # without aggregation, the stats keep going out as one raw dict
             data['time'] = int(time.time())
-
-            mqtt_client = self.get_mqtt_client(self.name)
-            mqtt_client.publish(self.mqtt_topic, json.dumps(data))
+            self.publish(json.dumps(data))
         else:
-            raise FreeboxException('failed to get connection information')
+            fields = {k: data[k] for k in self.STATS if k in data}
+            self.emit({'timestamp': int(time.time()), 'measurement': 'freebox', 'fields': fields})
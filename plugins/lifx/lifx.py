@@ -1,8 +1,11 @@
+from concurrent.futures import ThreadPoolExecutor, wait
 import json
-from lifxlan import LifxLAN
+from lifxlan import LifxLAN, WorkflowException
+from lifxlan.msgtypes import LightGet, LightState
 import logging
 import plugin
 import schedule
+import threading
 import time
 
 
@@ -15,34 +18,108 @@ class Lifx(plugin.Plugin):
         self.description = 'Lifx Light'
         self.mqtt_topic = '/iot/lifx'
 
+        # lights found by the last discovery, with their cached labels
+        self.lifx = None
+        self.devices = {}
+        self.discovered_at = 0
+        self.lock = threading.Lock()
+
+        # one poll thread per light (and at most one poll per light), so
+        # that every poll starts right away and the deadline of the job is
+        # the one of each light
+        self.pool = None
+        self.pool_size = 0
+        self.configure()
+
+    def configure(self):
+        self.interval = self.config.get('interval', 60)
+        self.discovery_interval = self.config.get('discovery_interval', 600)
+        self.device_timeout = self.config.get('device_timeout', 1)
+
     def scheduler(self):
         scheduler = schedule.Scheduler()
-        scheduler.every().minutes.do(self.run_threaded, self.job)
+        scheduler.every(self.interval).seconds.do(self.run_threaded, self.job)
         return scheduler
 
+    def discover(self):
+        logging.info('discovering Lifx lights')
+        if self.lifx is None:
+            self.lifx = LifxLAN()
+
+        devices = {}
+        for device in self.lifx.get_lights():
+            mac = device.get_mac_addr()
+            known = self.devices.get(mac)
+            if known is not None:
+                known['device'] = device
+                devices[mac] = known
+                continue
+            try:
+                devices[mac] = {
+                    'device': device,
+                    'label': device.get_label(),
+                    'location': device.get_location_label(),
+                }
+            except WorkflowException as ex:
+                logging.warning(f'Lifx light {mac} did not answer: {ex}')
+
+        with self.lock:
+            self.devices = devices
+        self.discovered_at = time.monotonic()
+        logging.debug(f'{len(devices)} Lifx lights found')
+
+        size = max(len(devices), self.config.get('poll_workers', 8))
+        if size > self.pool_size:
+            if self.pool is not None:
+                self.pool.shutdown(wait=False)
+            self.pool = ThreadPoolExecutor(max_workers=size, thread_name_prefix='lifx')
+            self.pool_size = size
+
+    def poll(self, mac, entry):
+        """Ask one light for its state (color, power and label in one round-trip)
+        """
+        response = entry['device'].req_with_resp(LightGet, LightState, timeout_secs=self.device_timeout)
+        entry['label'] = response.label
+
+        measurement = 'lifx_' + entry['location'] + '_' + entry['label']
+        color = response.color
+        return {
+            'timestamp': int(time.time()),
+            'measurement': measurement.lower(),
+            'fields': {
+                'powered': 1 if response.power_level != 0 else 0,
+                'hue': color[0],
+                'saturation': color[1],
+                'brightness': color[2],
+                'kelvin': color[3],
+            },
+        }
+
     def job(self):
-        lifx = LifxLAN()
+        if not self.devices or time.monotonic() - self.discovered_at >= self.discovery_interval:
+            self.discover()
+
         logging.info('retrieving data from Lifx')
+        futures = {}
+        with self.lock:
+            devices = list(self.devices.items())
+        for mac, entry in devices:
+            # at most one poll in flight per light, they never pile up
+            if entry.get('poll') is not None and not entry['poll'].done():
+                logging.warning(f'Lifx light {mac} still polled since last run, skipping it')
+                continue
+            entry['poll'] = self.pool.submit(self.poll, mac, entry)
+            futures[entry['poll']] = mac
+        # a poll makes one attempt of device_timeout seconds
+        done, not_done = wait(futures, timeout=self.device_timeout * 2 + 1)
 
-        data = []
-        for device in lifx.get_lights():
-            logging.debug('Lifx light: ' + device.get_label())
-
-            measurement = 'lifx_' + device.get_location_label() + '_' + device.get_label()
-            color = device.get_color()
-
-            data.append({
-                'timestamp': int(time.time()),
-                'measurement': measurement.lower(),
-                'fields': {
-                    'powered': 1 if device.get_power() != 0 else 0,
-                    'hue': color[0],
-                    'saturation': color[1],
-                    'brightness': color[2],
-                    'kelvin': color[3],
-                },
-            })
-
-        mqtt_client = self.get_mqtt_client(self.name)
-        logging.debug(json.dumps(data))
-        mqtt_client.publish(self.mqtt_topic, json.dumps(data))
+        for future in not_done:
+            future.cancel()
+            logging.warning(f'Lifx light {futures[future]} timed out')
+        for future in done:
+            if future.exception() is not None:
+                logging.warning(f'Lifx light {futures[future]} did not answer: {future.exception()}')
+                continue
+            point = future.result()
+            logging.debug(json.dumps(point))
+            self.emit(point)
@@ -1,33 +1,172 @@
+import glob
 import json
 import logging
+import os
 import plugin
 import schedule
 import socket
+import threading
 import time
 
 
-def get_cpu_temp():
-    with open('/sys/class/thermal/thermal_zone0/temp') as f:
-        data = f.read().strip()
-    return float(data) / 1000.
+class ProcFile(object):
+    """A /proc or /sys file kept open and re-read from offset 0 with pread
+    """
 
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY)
+        self.size = 4096
 
-def get_cpu_load_1m():
-    with open('/proc/loadavg') as f:
-        data = f.read().strip()
-    return float(data.split(' ')[0])
+    def read(self):
+        data = os.pread(self.fd, self.size, 0)
+        while len(data) >= self.size:
+            self.size *= 2
+            data = os.pread(self.fd, self.size, 0)
+        return data.decode('ascii', 'replace')
 
+    def close(self):
+        os.close(self.fd)
 
-def get_cpu_load_5m():
-    with open('/proc/loadavg') as f:
-        data = f.read().strip()
-    return float(data.split(' ')[1])
 
+class SystemSampler(object):
+    """Samples load, cpu, memory, network, disks and thermal zones. Counters
+    are turned into rates from the delta with the previous sample, and the
+    samples are aggregated (mean) until collected by take()
+    """
 
-def get_cpu_load_15m():
-    with open('/proc/loadavg') as f:
-        data = f.read().strip()
-    return float(data.split(' ')[2])
+    SECTOR_SIZE = 512
+
+    def __init__(self):
+        self.files = {}
+        for name, path in (
+                ('loadavg', '/proc/loadavg'),
+                ('stat', '/proc/stat'),
+                ('meminfo', '/proc/meminfo'),
+                ('net', '/proc/net/dev'),
+                ('disk', '/proc/diskstats')):
+            self.open(name, path)
+
+        self.zones = []
+        for zone in sorted(glob.glob('/sys/class/thermal/thermal_zone*')):
+            temp = self.open(os.path.basename(zone), os.path.join(zone, 'temp'))
+            if temp is None:
+                continue
+            try:
+                with open(os.path.join(zone, 'type')) as f:
+                    kind = f.read().strip().replace('-', '_').lower()
+            except OSError:
+                kind = os.path.basename(zone)
+            self.zones.append((kind, temp))
+
+        self.lock = threading.Lock()
+        self.previous = None
+        self.sums = {}
+
+    def open(self, name, path):
+        try:
+            self.files[name] = ProcFile(path)
+        except OSError as ex:
+            logging.warning(f'cannot sample {path}: {ex}')
+            return None
+        return self.files[name]
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+
+    def counters(self):
+        """Raw cumulative counters, turned into rates by sample()
+        """
+        counters = {}
+        if 'stat' in self.files:
+            for line in self.files['stat'].read().splitlines():
+                values = line.split()
+                if values[0] == 'cpu':
+                    ticks = [int(v) for v in values[1:9]]
+                    counters['cpu_total'] = sum(ticks)
+                    counters['cpu_idle'] = ticks[3] + ticks[4]
+                    counters['cpu_user'] = ticks[0] + ticks[1]
+                    counters['cpu_system'] = ticks[2] + ticks[5] + ticks[6]
+                    counters['cpu_iowait'] = ticks[4]
+                elif values[0] in ('ctxt', 'intr'):
+                    counters[values[0]] = int(values[1])
+        if 'net' in self.files:
+            for line in self.files['net'].read().splitlines()[2:]:
+                iface, values = line.split(':', 1)
+                iface = iface.strip()
+                if iface == 'lo':
+                    continue
+                values = values.split()
+                counters[f'net_{iface}_rx'] = int(values[0])
+                counters[f'net_{iface}_tx'] = int(values[8])
+        if 'disk' in self.files:
+            for line in self.files['disk'].read().splitlines():
+                values = line.split()
+                if values[2].startswith(('loop', 'ram')):
+                    continue
+                counters[f'disk_{values[2]}_read'] = int(values[5]) * self.SECTOR_SIZE
+                counters[f'disk_{values[2]}_write'] = int(values[9]) * self.SECTOR_SIZE
+        return counters
+
+    def gauges(self):
+        fields = {}
+        if 'loadavg' in self.files:
+            load = self.files['loadavg'].read().split()
+            fields['cpu_load_1m'] = float(load[0])
+            fields['cpu_load_5m'] = float(load[1])
+            fields['cpu_load_15m'] = float(load[2])
+        if 'meminfo' in self.files:
+            meminfo = {}
+            for line in self.files['meminfo'].read().splitlines():
+                key, value = line.split(':', 1)
+                meminfo[key] = int(value.split()[0]) * 1024
+            fields['mem_total'] = meminfo.get('MemTotal', 0)
+            fields['mem_available'] = meminfo.get('MemAvailable', meminfo.get('MemFree', 0))
+            fields['swap_used'] = meminfo.get('SwapTotal', 0) - meminfo.get('SwapFree', 0)
+        for i, (kind, temp) in enumerate(self.zones):
+            value = float(temp.read().strip()) / 1000.
+            if i == 0:
+                fields['cpu_temp'] = value
+            fields[f'temp_{kind}'] = value
+        return fields
+
+    def sample(self):
+        """Take one sample and add it to the running aggregate
+        """
+        now = time.monotonic()
+        fields = self.gauges()
+        counters = self.counters()
+
+        with self.lock:
+            if self.previous is not None:
+                before, previous = self.previous
+                elapsed = now - before
+                delta = {k: v - previous[k] for k, v in counters.items() if k in previous}
+                # cpu ticks become percentages of the elapsed ticks
+                total = delta.pop('cpu_total', 0)
+                ticks = {k: delta.pop(f'cpu_{k}', 0) for k in ('idle', 'user', 'system', 'iowait')}
+                if total > 0:
+                    fields['cpu_usage'] = 100. * (total - ticks.pop('idle')) / total
+                    for key, value in ticks.items():
+                        fields[f'cpu_usage_{key}'] = 100. * value / total
+                if elapsed > 0:
+                    for key, value in delta.items():
+                        fields[key + '_rate'] = value / elapsed
+            self.previous = (now, counters)
+
+            for key, value in fields.items():
+                total, count = self.sums.get(key, (0, 0))
+                self.sums[key] = (total + value, count + 1)
+
+    def take(self):
+        """Return the mean of the samples taken since last call, and reset
+        """
+        with self.lock:
+            fields = {k: round(total / count, 3) for k, (total, count) in self.sums.items()}
+            self.sums = {}
+            return fields
 
 
 class RasPi(plugin.Plugin):
@@ -39,44 +178,41 @@ class RasPi(plugin.Plugin):
         self.description = 'RaspberryPi SysInfo'
         self.mqtt_topic = '/system/raspi'
 
+        self.sampler = SystemSampler()
+        self.configure()
+
+    def configure(self):
+        # sampling faster than the publish interval averages the samples
+        self.interval = self.config.get('interval', 5)
+        self.sample_interval = self.config.get('sample_interval', self.interval)
+
+    def __del__(self):
+        self.sampler.close()
+
     def scheduler(self):
         scheduler = schedule.Scheduler()
-        scheduler.every(5).seconds.do(self.run_threaded, self.job)
+        if self.sample_interval < self.interval:
+            scheduler.every(self.sample_interval).seconds.do(self.run_threaded, self.sample)
+        scheduler.every(self.interval).seconds.do(self.run_threaded, self.job)
         return scheduler
 
+    def sample(self):
+        self.sampler.sample()
+
     def job(self):
         logging.info('retrieving data from raspberry pi')
 
-        measures = [
-            {
-                'name': 'cpu_temp',
-                'get': get_cpu_temp,
-            },
-            {
-                'name': 'cpu_load_1m',
-                'get': get_cpu_load_1m,
-            },
-            {
-                'name': 'cpu_load_5m',
-                'get': get_cpu_load_5m,
-            },
-            {
-                'name': 'cpu_load_15m',
-                'get': get_cpu_load_15m,
-            },
-        ]
-
-        fields = {}
-        for m in measures:
-            fields[m['name']] = m['get']()
+        if self.sample_interval >= self.interval:
+            self.sampler.sample()
+        fields = self.sampler.take()
+        if not fields:
+            return
 
-        data = []
-        data.append({
+        point = {
             'timestamp': int(time.time()),
             'measurement': socket.gethostname().replace('-', '_'),
             'fields': fields,
-        })
+        }
 
-        mqtt_client = self.get_mqtt_client(self.name)
-        logging.debug(json.dumps(data))
-        mqtt_client.publish(self.mqtt_topic, json.dumps(data))
+        logging.debug(json.dumps(point))
+        self.emit(point)
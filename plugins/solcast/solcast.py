@@ -1,11 +1,9 @@
 import datetime
-import dateutil.parser
-import dateutil.tz
-import json
 import logging
+from pipeline import response_items
 import plugin
-import requests
 import schedule
+from timestamps import parse_timestamp
 
 
 class Solcast(plugin.Plugin):
@@ -16,42 +14,64 @@ class Solcast(plugin.Plugin):
         self.version = '1.0'
         self.description = 'Solar Power Radiation Collector'
         self.mqtt_topic = '/power/solcast'
+        self.deduplicate = True
 
-        self.url_base = 'https://api.solcast.com.au/'
+        # estimated actuals only go a week back, the history endpoint
+        # serves up to 31 days per call
+        self.backfill_chunk = datetime.timedelta(days=31)
+        self.backfill_workers = 2
+
+        self.configure()
+
+    def configure(self):
+        self.url_base = self.config.get('url', 'https://api.solcast.com.au/')
+        self.interval = self.config.get('interval', 30)
 
     def scheduler(self):
         scheduler = schedule.Scheduler()
-        scheduler.every(30).minutes.do(self.run_threaded, self.job)
+        scheduler.every(self.interval).minutes.do(self.run_threaded, self.job)
         return scheduler
 
-    def job(self):
-        headers = {
+    def headers(self):
+        return {
             'Authorization': 'Bearer {}'.format(self.config['api_key']),
             'Accept': 'application/json',
         }
 
+    def job(self):
         logging.info('retrieving data from Solcast')
-        r = requests.get(
+        r = self.http.get(
                 self.url_base +
                 'world_radiation/estimated_actuals?latitude={}&longitude={}'.format(self.config['latitude'], self.config['longitude']),
-                headers=headers)
-        # logging.debug('result: status=' + str(r.status_code) + ', json=' + json.dumps(r.json()))
-
-        mqtt_client = self.get_mqtt_client(self.name)
+                headers=self.headers(), stream=True)
         # tz = dateutil.tz.gettz(self.config['timezone'])
-        for measure in r.json()['estimated_actuals']:
-            dt = dateutil.parser.parse(measure['period_end'])
-            # dt = dt.astimezone(tz)
-            data = [
-                {
-                    'timestamp': int(datetime.datetime.timestamp(dt)),
-                    'measurement': 'solcast',
-                    'fields': {
-                        'global_horizontal_irradiance': measure['ghi'],
-                        'direct_normal_irradiance': measure['dni'],
-                        'diffuse_horizontal_irradiance': measure['dhi'],
-                        'cloud_opacity': measure['cloud_opacity'],
-                    },
-                }
-            ]
-            mqtt_client.publish(self.mqtt_topic, json.dumps(data))
+        self.emit_actuals(r)
+
+    def backfill(self, start, end):
+        logging.info(f'retrieving history from Solcast, {start} to {end}')
+        r = self.http.get(
+                self.url_base +
+                'data/historic/radiation_and_weather?latitude={}&longitude={}&start={}&end={}&period=PT30M'
+                '&output_parameters=ghi,dni,dhi,cloud_opacity&format=json'.format(
+                    self.config['latitude'], self.config['longitude'],
+                    start.strftime('%Y-%m-%dT00:00:00Z'), (end + datetime.timedelta(days=1)).strftime('%Y-%m-%dT00:00:00Z')),
+                headers=self.headers(), stream=True)
+        self.emit_actuals(r)
+
+    def emit_actuals(self, r):
+        logging.debug(f'result: status={r.status_code}')
+        r.raise_for_status()
+        self.emit_all(self.transform(response_items(r, 'estimated_actuals.item')))
+
+    def transform(self, measures):
+        for measure in measures:
+            yield {
+                'timestamp': parse_timestamp(measure['period_end']),
+                'measurement': 'solcast',
+                'fields': {
+                    'global_horizontal_irradiance': measure['ghi'],
+                    'direct_normal_irradiance': measure['dni'],
+                    'diffuse_horizontal_irradiance': measure['dhi'],
+                    'cloud_opacity': measure['cloud_opacity'],
+                },
+            }
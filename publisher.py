@@ -0,0 +1,139 @@
+import logging
+import os
+import threading
+import time
+
+from encoders import get_encoder
+
+
+class BatchPublisher(object):
+    """Coalesces the datapoints handed by the plugins into one list payload
+    per topic, encoded with the encoder selected for the topic (JSON by
+    default). A batch is published as soon as it holds max_points points
+    or max_bytes bytes, or when its oldest point is max_linger seconds old
+    """
+
+    def __init__(self, mqtt, max_points=None, max_bytes=None, max_linger=None):
+        self.mqtt = mqtt
+        self.max_points = max_points or int(os.getenv('COLLECTOR_BATCH_POINTS', 500))
+        self.max_bytes = max_bytes or int(os.getenv('COLLECTOR_BATCH_BYTES', 65536))
+        self.max_linger = max_linger or float(os.getenv('COLLECTOR_BATCH_LINGER', 1.0))
+
+        self.default_encoder = get_encoder()
+        self.encoders = {}
+        self.batches = {}
+        self.cond = threading.Condition()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        """Start the thread flushing the batches older than max_linger
+        """
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='publisher', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop the linger thread and publish whatever is still buffered
+        """
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
+
+    def set_encoding(self, topic, name):
+        """Select the encoder of topic, batches are then published on the
+        topic followed by the encoder topic suffix (e.g. /lp). The pending
+        batch of topic is published first, in the former encoding
+        """
+        encoder = get_encoder(name)
+        payloads = []
+        with self.cond:
+            if topic in self.batches and self.batches[topic]['encoder'].name != encoder.name:
+                payloads.append(self._take(topic))
+            self.encoders[topic] = encoder
+        for t, payload in payloads:
+            self.mqtt.publish(t, payload)
+
+    def add(self, topic, point):
+        """Add one datapoint to the batch of topic
+        """
+        encoder = self.encoders.get(topic, self.default_encoder)
+        encoded = encoder.encode(point)
+        if encoded is None:
+            return
+
+        payloads = []
+        with self.cond:
+            self._append(topic, encoder, encoded, payloads)
+        for t, payload in payloads:
+            self.mqtt.publish(t, payload)
+
+    def add_buffer(self, topic, buffer):
+        """Add the rows of a ColumnBuffer to the batch of topic, encoded
+        straight from its arrays
+        """
+        encoder = self.encoders.get(topic, self.default_encoder)
+        for encoded in encoder.encode_rows(buffer):
+            payloads = []
+            with self.cond:
+                self._append(topic, encoder, encoded, payloads)
+            for t, payload in payloads:
+                self.mqtt.publish(t, payload)
+
+    def _append(self, topic, encoder, encoded, payloads):
+        """Append one encoded point to the batch of topic, adding the batches
+        to publish to payloads. Called with the lock held
+        """
+        batch = self.batches.get(topic)
+        # a point encoded before the encoding of topic changed never shares a batch with the others
+        if batch is not None and (batch['encoder'].name != encoder.name
+                                  or batch['size'] + len(encoded) + encoder.separator_size > self.max_bytes):
+            payloads.append(self._take(topic))
+            batch = None
+        if batch is None:
+            batch = self.batches[topic] = {
+                'encoder': encoder,
+                'points': [],
+                'size': encoder.header_size,
+                'since': time.monotonic(),
+            }
+            self.cond.notify()
+
+        batch['points'].append(encoded)
+        batch['size'] += len(encoded) + encoder.separator_size
+        if len(batch['points']) >= self.max_points or batch['size'] >= self.max_bytes:
+            payloads.append(self._take(topic))
+
+    def flush(self, topic=None):
+        """Publish the pending batch of topic, or of all topics
+        """
+        with self.cond:
+            topics = list(self.batches) if topic is None else [t for t in [topic] if t in self.batches]
+            payloads = [self._take(t) for t in topics]
+        for t, payload in payloads:
+            self.mqtt.publish(t, payload)
+
+    def _take(self, topic):
+        batch = self.batches.pop(topic)
+        encoder = batch['encoder']
+        logging.debug(f'flushing {len(batch["points"])} points ({batch["size"]} bytes) to {topic} as {encoder.name}')
+        return topic + encoder.topic_suffix, encoder.join(batch['points'])
+
+    def run(self):
+        while True:
+            with self.cond:
+                if not self.running:
+                    return
+                now = time.monotonic()
+                expired = [t for t, b in self.batches.items() if now - b['since'] >= self.max_linger]
+                payloads = [self._take(t) for t in expired]
+                if not payloads:
+                    deadlines = [b['since'] + self.max_linger for b in self.batches.values()]
+                    self.cond.wait(min(deadlines) - now if deadlines else None)
+                    continue
+
+            for topic, payload in payloads:
+                self.mqtt.publish(topic, payload)
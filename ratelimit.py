@@ -0,0 +1,71 @@
+import threading
+import time
+
+
+class TokenBucket(object):
+    """Token bucket spreading API calls over a quota of capacity calls per
+    period. The bucket refills continuously, but never above what the server
+    reported as remaining in its current window (see update()), so both the
+    local pacing and the server quota are respected.
+
+    Callers pass a reserve to try_acquire(): low priority calls only get a
+    token while more than reserve tokens are left, keeping the rest for the
+    high priority ones
+    """
+
+    def __init__(self, capacity, period):
+        self.capacity = capacity
+        self.period = period
+        self.rate = capacity / period
+
+        self.lock = threading.Lock()
+        self.tokens = float(capacity)
+        self.stamp = time.monotonic()
+        self.remaining = capacity
+        self.reset_at = None
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.reset_at is not None and now >= self.reset_at:
+            self.remaining = self.capacity
+            self.reset_at = None
+
+    def available(self):
+        with self.lock:
+            self._refill(time.monotonic())
+            return min(self.tokens, self.remaining)
+
+    def try_acquire(self, tokens=1, reserve=0):
+        """Take tokens if, once taken, more than reserve are still available
+        """
+        with self.lock:
+            self._refill(time.monotonic())
+            if min(self.tokens, self.remaining) - tokens < reserve:
+                return False
+            self.tokens -= tokens
+            if self.reset_at is not None:
+                self.remaining -= tokens
+            return True
+
+    def update(self, remaining, reset_in):
+        """Synchronise with the quota reported by the server: remaining calls
+        in the current window, which resets in reset_in seconds
+        """
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.remaining = remaining
+            self.reset_at = now + reset_in
+            self.tokens = min(self.tokens, remaining)
+
+    def wait_time(self, tokens=1, reserve=0):
+        """Seconds until try_acquire(tokens, reserve) may succeed
+        """
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            if self.remaining - tokens < reserve:
+                return self.reset_at - now if self.reset_at is not None else self.period
+            missing = tokens + reserve - self.tokens
+            return max(0.0, missing / self.rate)
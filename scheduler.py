@@ -0,0 +1,164 @@
+import asyncio
+import datetime
+import heapq
+import itertools
+import logging
+import threading
+
+import schedule
+
+import metrics
+
+
+def job_name(job):
+    """Readable name of a schedule.Job, unwrapping run_threaded(job_func)
+    """
+    func = job.job_func
+    if func.args and callable(func.args[0]):
+        return func.args[0].__name__
+    return func.func.__name__
+
+
+class EventScheduler(object):
+    """Heap ordered scheduler driving the jobs of the plugins schedulers.
+    It sleeps until the next job is due and is woken up early whenever
+    jobs are added, so intervals below one second are honoured
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+        self.running = False
+        self.lateness = {}
+        self.schedulers = {}
+
+    def add(self, name, scheduler, run_now=True):
+        """Add all the jobs of a schedule.Scheduler, by default running
+        them immediately once
+        """
+        now = datetime.datetime.now()
+        with self.cond:
+            self.schedulers[name] = scheduler
+            for job in scheduler.jobs:
+                planned = now if run_now else job.next_run
+                heapq.heappush(self.heap, (planned, next(self.counter), name, scheduler, job))
+            self._wake()
+
+    def replace(self, name, scheduler, run_now=False):
+        """Swap the jobs added under name for those of scheduler, by default
+        running them at their first scheduled time
+        """
+        with self.cond:
+            self.heap = [entry for entry in self.heap if entry[2] != name]
+            heapq.heapify(self.heap)
+            self.add(name, scheduler, run_now=run_now)
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self._wake()
+
+    def _wake(self):
+        self.cond.notify()
+
+    def run(self):
+        """Run the jobs as they become due, until stop() is called
+        """
+        self.running = True
+        while True:
+            with self.cond:
+                entry = None
+                while self.running:
+                    if not self.heap:
+                        self.cond.wait()
+                        continue
+                    delay = (self.heap[0][0] - datetime.datetime.now()).total_seconds()
+                    if delay <= 0:
+                        entry = heapq.heappop(self.heap)
+                        break
+                    self.cond.wait(delay)
+                if entry is None:
+                    return
+
+            self._run(*entry)
+
+    def _run(self, planned, _, name, scheduler, job):
+        start = datetime.datetime.now()
+        self._record_lateness(f'{name}.{job_name(job)}', (start - planned).total_seconds())
+
+        try:
+            ret = job.run()
+        except Exception as ex:
+            logging.error(f'{name}: {ex}')
+            ret = None
+            job._schedule_next_run()
+
+        if ret is schedule.CancelJob or isinstance(ret, schedule.CancelJob):
+            scheduler.cancel_job(job)
+            return
+
+        if job.at_time is None and job.start_day is None and job.latest is None:
+            # plain interval job: keep the cadence anchored on the planned
+            # time instead of drifting with the lateness of each run
+            next_run = planned + job.period
+            if next_run < start:
+                missed = (start - next_run) // job.period + 1
+                next_run += missed * job.period
+            job.next_run = next_run
+
+        with self.cond:
+            # the jobs may have been replaced while this one was running
+            if self.schedulers.get(name) is scheduler:
+                heapq.heappush(self.heap, (job.next_run, next(self.counter), name, scheduler, job))
+
+    def _record_lateness(self, key, lateness):
+        plugin, _, job = key.partition('.')
+        metrics.registry.observe('collector_scheduler_lateness_seconds', lateness, plugin=plugin, job=job)
+        stats = self.lateness.get(key)
+        if stats is None:
+            stats = self.lateness[key] = {'runs': 0, 'last': 0.0, 'max': 0.0, 'total': 0.0}
+        stats['runs'] += 1
+        stats['last'] = lateness
+        stats['max'] = max(stats['max'], lateness)
+        stats['total'] += lateness
+        if lateness > 1:
+            logging.warning(f'{key} started {lateness:.3f}s late')
+
+
+class AsyncScheduler(EventScheduler):
+    """EventScheduler driven by an asyncio event loop: run() is a coroutine
+    sleeping until the next job is due, woken up early by add() and stop()
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.loop = None
+        self.wakeup = None
+
+    def _wake(self):
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    async def run(self):
+        """Run the jobs as they become due, until stop() is called
+        """
+        self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        self.running = True
+        while self.running:
+            with self.cond:
+                delay = None
+                if self.heap:
+                    delay = (self.heap[0][0] - datetime.datetime.now()).total_seconds()
+                entry = heapq.heappop(self.heap) if delay is not None and delay <= 0 else None
+
+            if entry is not None:
+                self._run(*entry)
+                continue
+
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
@@ -0,0 +1,268 @@
+import json
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import threading
+import time
+
+from connection import MqttConnection
+from metrics import MetricsReporter
+from outbox import Outbox
+from plugin import PluginCollection, walk_plugins
+
+
+class PipeConnection(object):
+    """Stand-in for MqttConnection in a worker process: messages are sent
+    over a pipe to the supervisor, which publishes them on its connection
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+        self.outbox = None
+
+    def start(self, timeout=None):
+        pass
+
+    def stop(self, timeout=None):
+        self.conn.close()
+
+    def start_async(self, loop):
+        pass
+
+    async def stop_async(self, timeout=None):
+        self.conn.close()
+
+    def publish(self, topic, payload, qos=0, retain=False, spool=True):
+        with self.lock:
+            self.conn.send((topic, payload, qos, retain, spool))
+
+
+def assign(names, workers, groups=None, costs=None):
+    """Split the plugin names into workers shards: each group stays in one
+    shard, and the heaviest groups or plugins (by cost, 1 when unknown) go
+    first to the least loaded shard
+    """
+    costs = costs or {}
+    known = [c for n, c in costs.items() if n in names]
+    default = sorted(known)[len(known) // 2] if known else 1.0
+
+    units = []
+    grouped = set()
+    for group in groups or ():
+        unit = [n for n in group if n in names and n not in grouped]
+        if unit:
+            units.append(unit)
+            grouped.update(unit)
+    units += [[n] for n in names if n not in grouped]
+
+    shards = [[] for _ in range(workers)]
+    loads = [0.0] * workers
+    for unit in sorted(units, key=lambda u: -sum(costs.get(n, default) for n in u)):
+        i = loads.index(min(loads))
+        shards[i] += unit
+        loads[i] += sum(costs.get(n, default) for n in unit)
+    return [shard for shard in shards if shard]
+
+
+def run_worker(index, package, names, conn, runtime, level):
+    """Entry point of a worker process: run the plugins of its shard,
+    publishing through the pipe, until interrupted
+    """
+    logging.basicConfig(format=f'%(asctime)s %(levelname)-8s worker{index} [%(lineno)-3d]%(filename)-20s: %(message)s', level=level)
+    # the dedup entries of each worker go to their own file
+    if os.getenv('COLLECTOR_DEDUP_PATH'):
+        os.environ['COLLECTOR_DEDUP_PATH'] += f'.worker{index}'
+
+    plugins = PluginCollection(package, filter_by_names=names, mqtt=PipeConnection(conn))
+    plugins.metrics.topic += f'/worker{index}'
+    plugins.metrics.port = 0
+    plugins.list()
+    try:
+        if runtime == 'asyncio':
+            plugins.run_async()
+            return
+        plugins.connect()
+        try:
+            plugins.schedule()
+        finally:
+            plugins.close()
+    except KeyboardInterrupt:
+        pass
+
+
+class Worker(object):
+    """One worker process slot, restarted with exponential backoff
+    """
+
+    MIN_BACKOFF = 1
+    MAX_BACKOFF = 60
+    # a worker running that long is considered healthy again
+    STABLE_AFTER = 60
+
+    def __init__(self, index, names):
+        self.index = index
+        self.names = names
+        self.process = None
+        self.reader = None
+        self.started = 0
+        self.restart_at = 0
+        self.failures = 0
+        # job seconds per plugin, of previous runs and of the current one
+        self.job_time = {}
+        self.run_job_time = {}
+        self.run_time = 0.0
+
+    def start(self, context, package, runtime):
+        reader, writer = context.Pipe(duplex=False)
+        self.process = context.Process(
+            target=run_worker,
+            args=(self.index, package, self.names, writer, runtime, logging.getLogger().level),
+            name=f'collector-worker{self.index}',
+            daemon=False)
+        self.process.start()
+        writer.close()
+        self.reader = reader
+        self.started = time.monotonic()
+        logging.info(f'worker{self.index} started (pid {self.process.pid}): {", ".join(self.names)}')
+
+    def exited(self):
+        """Account for the end of the process, returns the backoff delay
+        """
+        uptime = time.monotonic() - self.started
+        self.run_time += uptime
+        for name, seconds in self.run_job_time.items():
+            self.job_time[name] = self.job_time.get(name, 0.0) + seconds
+        self.run_job_time = {}
+        self.reader.close()
+        self.reader = None
+
+        self.failures = 0 if uptime >= self.STABLE_AFTER else self.failures + 1
+        return min(self.MAX_BACKOFF, self.MIN_BACKOFF * 2 ** (self.failures - 1)) if self.failures else self.MIN_BACKOFF
+
+    def costs(self):
+        """Job seconds per hour of each plugin of the worker
+        """
+        uptime = self.run_time + (time.monotonic() - self.started if self.reader is not None else 0)
+        if uptime <= 0:
+            return {}
+        total = dict(self.job_time)
+        for name, seconds in self.run_job_time.items():
+            total[name] = total.get(name, 0.0) + seconds
+        return {name: 3600. * seconds / uptime for name, seconds in total.items()}
+
+
+class Supervisor(object):
+    """Runs the plugins in workers worker processes, assigned by explicit
+    groups or by their measured cost, and restarts the workers that crash.
+    The workers hand their batches over pipes to the supervisor, which
+    owns the one (spooled) MQTT connection
+    """
+
+    def __init__(self, plugin_package, workers, groups=None, filter_by_names=None, runtime='threads', cost_path=None):
+        self.plugin_package = plugin_package
+        self.runtime = runtime
+        self.cost_path = cost_path or os.getenv(
+                'COLLECTOR_COST_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'costs.json'))
+        self.costs = {}
+        if os.path.exists(self.cost_path):
+            with open(self.cost_path) as f:
+                self.costs = json.load(f)
+
+        manifest = walk_plugins(plugin_package)
+        if filter_by_names is None:
+            names = [m['name'] for m in manifest if m['active']]
+        else:
+            names = [m['name'] for m in manifest if m['name'] in filter_by_names]
+        shards = assign(names, workers, groups, self.costs)
+        self.workers = [Worker(i, shard) for i, shard in enumerate(shards)]
+
+        self.context = multiprocessing.get_context('spawn')
+        self.mqtt = MqttConnection(outbox=Outbox())
+        self.metrics = MetricsReporter(self.mqtt)
+        self.running = False
+
+    def run(self):
+        """Start the workers and relay their messages, until interrupted
+        """
+        self.mqtt.start()
+        self.metrics.start()
+        for worker in self.workers:
+            worker.start(self.context, self.plugin_package, self.runtime)
+
+        self.running = True
+        try:
+            while self.running:
+                self.poll(1)
+                self.restart()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.shutdown()
+
+    def poll(self, timeout):
+        readers = {w.reader: w for w in self.workers if w.reader is not None}
+        for reader in multiprocessing.connection.wait(list(readers), timeout):
+            worker = readers[reader]
+            try:
+                while reader.poll():
+                    self.relay(worker, *reader.recv())
+            except (EOFError, OSError):
+                worker.process.join()
+                delay = worker.exited()
+                worker.restart_at = time.monotonic() + delay
+                if self.running:
+                    logging.error(f'worker{worker.index} exited with code {worker.process.exitcode}, restarting in {delay}s')
+
+    def relay(self, worker, topic, payload, qos, retain, spool):
+        if topic.startswith(self.metrics.topic + '/'):
+            self.record_costs(worker, payload)
+        self.mqtt.publish(topic, payload, qos=qos, retain=retain, spool=spool)
+
+    def record_costs(self, worker, payload):
+        job_time = {}
+        for sample in json.loads(payload)['metrics'].get('collector_job_duration_seconds', []):
+            name = sample['labels']['plugin']
+            job_time[name] = job_time.get(name, 0.0) + sample['value']['sum']
+        worker.run_job_time = job_time
+
+    def restart(self):
+        now = time.monotonic()
+        for worker in self.workers:
+            if self.running and worker.reader is None and now >= worker.restart_at:
+                worker.start(self.context, self.plugin_package, self.runtime)
+
+    def shutdown(self, timeout=10):
+        """Interrupt the workers, relay what they flush while stopping, then
+        close the connection
+        """
+        self.running = False
+        for worker in self.workers:
+            if worker.reader is not None and worker.process.is_alive():
+                os.kill(worker.process.pid, signal.SIGINT)
+
+        deadline = time.monotonic() + timeout
+        while any(w.reader is not None for w in self.workers) and time.monotonic() < deadline:
+            try:
+                self.poll(0.1)
+            except KeyboardInterrupt:
+                pass
+        for worker in self.workers:
+            if worker.reader is not None:
+                logging.warning(f'worker{worker.index} did not stop, killing it')
+                worker.process.kill()
+                worker.process.join()
+                worker.exited()
+
+        self.save_costs()
+        self.metrics.stop()
+        self.mqtt.stop()
+
+    def save_costs(self):
+        for worker in self.workers:
+            self.costs.update(worker.costs())
+        with open(self.cost_path + '.tmp', 'w') as f:
+            json.dump(self.costs, f)
+        os.replace(self.cost_path + '.tmp', self.cost_path)
@@ -1,20 +1,49 @@
 #!python3
 
 import argparse
+import asyncio
+import datetime
 import logging
 
+from backfill import Backfill
+from connection import MqttConnection
+from outbox import Outbox
 from plugin import PluginCollection
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-p', '--plugin')
+    parser.add_argument('-b', '--backfill', action='store_true', help='fetch the history of the plugin instead of running its job')
+    parser.add_argument('--from', dest='start', type=datetime.date.fromisoformat, help='first day to backfill (YYYY-MM-DD)')
+    parser.add_argument('--to', dest='end', type=datetime.date.fromisoformat,
+                        default=datetime.date.today() - datetime.timedelta(days=1), help='last day to backfill (default: yesterday)')
+    parser.add_argument('-w', '--workers', type=int, help='chunks fetched at once (default: set by the plugin)')
     args = parser.parse_args()
-
-    plugins = PluginCollection('plugins', filter_by_names=[args.plugin])
-    for plugin in plugins.plugins:
-        logging.info(f'running plugin {plugin.name}/{plugin.version}')
-        plugin.job()
+    if args.backfill and (args.plugin is None or args.start is None):
+        parser.error('--backfill needs --plugin and --from')
+
+    # own client id and spool, a running collector is left alone
+    mqtt = MqttConnection(client_id='collector-tester', outbox=Outbox(name='tester'))
+    plugins = PluginCollection('plugins', filter_by_names=[args.plugin], mqtt=mqtt)
+    plugins.connect()
+    try:
+        for plugin in plugins.plugins:
+            if args.backfill:
+                try:
+                    backfill = Backfill(plugin, args.start, args.end, workers=args.workers)
+                except ValueError as ex:
+                    logging.error(ex)
+                    continue
+                backfill.run()
+                continue
+            logging.info(f'running plugin {plugin.name}/{plugin.version}')
+            if asyncio.iscoroutinefunction(plugin.job):
+                asyncio.run(plugin.job())
+            else:
+                plugin.job()
+    finally:
+        plugins.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,20 @@
+import datetime
+import functools
+
+import dateutil.parser
+
+
+@functools.lru_cache(maxsize=8192)
+def parse_timestamp(value):
+    """Epoch seconds of an ISO 8601 date or datetime (string or datetime),
+    naive values being local time. Results are cached, the same dates come
+    back again and again in the api payloads
+    """
+    if isinstance(value, str):
+        try:
+            value = datetime.datetime.fromisoformat(value)
+        except ValueError:
+            value = dateutil.parser.parse(value)
+    elif not isinstance(value, datetime.datetime):
+        value = datetime.datetime.combine(value, datetime.time())
+    return int(value.timestamp())